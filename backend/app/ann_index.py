@@ -0,0 +1,257 @@
+import time
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from app.quantization import CompactVectors, normalize_rows
+
+
+class PackedStrings:
+    """
+    Strings stored as one UTF-8 byte blob plus offsets. A NumPy string array
+    is fixed-width (every row as wide as the longest, at 4 bytes per
+    character), so one long prompt would inflate every row.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, strings: Sequence[str]) -> "PackedStrings":
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Returns the positions of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(len(scores))
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+def exact_search(vectors: np.ndarray, query: np.ndarray, k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+    """Brute-force top-k by cosine similarity. Returns (ids, scores)."""
+    scores = vectors @ normalize_rows(query)
+    best = _top_k(scores, k)
+    return best, scores[best]
+
+
+def _kmeans(vectors: np.ndarray, n_lists: int, iterations: int, seed: int) -> np.ndarray:
+    """Spherical k-means used to train the coarse quantizer."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_lists)
+        # Re-seed empty lists with random points so every list stays useful
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index over unit vectors.
+
+    Vectors are clustered around k-means centroids; a query only scores the
+    vectors in the `n_probe` lists whose centroids are closest to it. Vectors
+    are stored grouped by list so each probed list is one contiguous slice,
+    in the compact format chosen at build time (see app.quantization).
+    """
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, ids: np.ndarray,
+                 vectors: CompactVectors, n_probe: int = 6,
+                 metadata: Optional[Dict[str, Union[np.ndarray, PackedStrings]]] = None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.n_probe = n_probe
+        self.metadata = metadata or {}
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def dimensions(self) -> int:
+        return self.centroids.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, vectors, n_lists: Optional[int] = None, n_probe: int = 6,
+              iterations: int = 10, train_size: int = 65536, seed: int = 0,
+              storage: str = "float32",
+              metadata: Optional[Dict[str, Union[np.ndarray, PackedStrings]]] = None) -> "IVFIndex":
+        """Trains the coarse centroids and buckets every vector into its list."""
+        vectors = normalize_rows(vectors)
+        n = len(vectors)
+        if n == 0:
+            raise ValueError("Cannot build an index without vectors")
+        if n_lists is None:
+            n_lists = int(np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+
+        rng = np.random.default_rng(seed)
+        train = vectors if n <= train_size else vectors[rng.choice(n, train_size, replace=False)]
+        centroids = _kmeans(train, n_lists, iterations, seed)
+
+        # Assign in blocks to keep the n x n_lists score matrix small
+        assignment = np.empty(n, dtype=np.int64)
+        for start in range(0, n, 8192):
+            block = vectors[start:start + 8192]
+            assignment[start:start + 8192] = np.argmax(block @ centroids.T, axis=1)
+
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=n_lists)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids, offsets, order, CompactVectors.encode(vectors[order], storage),
+                   n_probe=n_probe, metadata=metadata)
+
+    def search(self, query, k: int = 5, n_probe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate top-k. Returns (ids, scores) with ids in insertion order."""
+        query = normalize_rows(query)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        lists = _top_k(self.centroids @ query, n_probe)
+
+        positions, scores = [], []
+        for lst in lists:
+            start, end = self.offsets[lst], self.offsets[lst + 1]
+            if start == end:
+                continue
+            scores.append(self.vectors.dot(query, start, end))
+            positions.append(np.arange(start, end))
+        if not scores:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = np.concatenate(scores)
+        positions = np.concatenate(positions)
+        best = _top_k(scores, k)
+        return self.ids[positions[best]], scores[best]
+
+    def save(self, path: str):
+        """Persists the index (and any metadata) as an uncompressed .npz."""
+        arrays = {}
+        for name, value in self.metadata.items():
+            if isinstance(value, PackedStrings):
+                arrays[f"packed_{name}_blob"], arrays[f"packed_{name}_offsets"] = value.blob, value.offsets
+            else:
+                arrays[f"meta_{name}"] = np.asarray(value)
+        if self.vectors.scales is not None:
+            arrays["scales"] = self.vectors.scales
+        np.savez(path, centroids=self.centroids, offsets=self.offsets, ids=self.ids,
+                 vectors=self.vectors.codes, n_probe=np.array(self.n_probe), **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path, allow_pickle=False) as data:
+            metadata = {name[5:]: data[name] for name in data.files if name.startswith("meta_")}
+            for name in data.files:
+                if name.startswith("packed_") and name.endswith("_blob"):
+                    key = name[7:-5]
+                    metadata[key] = PackedStrings(data[name], data[f"packed_{key}_offsets"])
+            scales = data["scales"] if "scales" in data.files else None
+            return cls(data["centroids"], data["offsets"], data["ids"],
+                       CompactVectors(data["vectors"], scales), n_probe=int(data["n_probe"]), metadata=metadata)
+
+    def original_vectors(self) -> np.ndarray:
+        """Returns the stored vectors as float32, back in insertion order (for exact search)."""
+        out = np.empty((len(self), self.vectors.dimensions), dtype=np.float32)
+        for start, rows in self.vectors.iter_slices():
+            out[self.ids[start:start + len(rows)]] = rows
+        return out
+
+
+def measure_recall(index: IVFIndex, queries, k: int = 10, n_probe: Optional[int] = None) -> Dict:
+    """
+    Compares the index against exact search over the same vectors.
+    Returns recall@k and mean per-query latency for both paths.
+    """
+    queries = normalize_rows(queries)
+    exact_vectors = index.original_vectors()
+    hits, ann_time, exact_time = 0, 0.0, 0.0
+
+    for query in queries:
+        t0 = time.perf_counter()
+        truth, _ = exact_search(exact_vectors, query, k)
+        t1 = time.perf_counter()
+        found, _ = index.search(query, k, n_probe=n_probe)
+        t2 = time.perf_counter()
+        exact_time += t1 - t0
+        ann_time += t2 - t1
+        hits += len(np.intersect1d(truth, found))
+
+    n = max(len(queries), 1)
+    return {
+        'recall': hits / float(n * min(k, len(index))),
+        'ann_ms': ann_time / n * 1000,
+        'exact_ms': exact_time / n * 1000,
+        'n_probe': min(n_probe or index.n_probe, index.n_lists),
+        'n_lists': index.n_lists,
+        'size': len(index)
+    }
+
+
+# Example usage: recall/latency sweep on a synthetic corpus shaped like text embeddings.
+# Points lie near a low-dimensional latent space (--latent-dim) with broad, overlapping topics,
+# so nearest neighbours straddle the k-means list boundaries, and the queries are fresh
+# samples rather than perturbed corpus points. (Well separated topics make every probe
+# count look perfect.)
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure IVF recall against exact search")
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--storage", default="float32", choices=["float32", "float16", "int8"])
+    parser.add_argument("--latent-dim", type=int, default=32)
+    parser.add_argument("--topics", type=int, default=64)
+    parser.add_argument("--spread", type=float, default=1.0, help="Within-topic spread, relative to topic separation")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    projection = rng.standard_normal((args.latent_dim, args.dim)).astype(np.float32) / np.sqrt(args.latent_dim)
+    topics = rng.standard_normal((args.topics, args.latent_dim)).astype(np.float32)
+
+    def sample(n: int) -> np.ndarray:
+        latent = topics[rng.integers(0, args.topics, n)] + args.spread * rng.standard_normal((n, args.latent_dim))
+        noise = 0.5 * rng.standard_normal((n, args.dim)) / np.sqrt(args.dim)
+        return (normalize_rows(latent.astype(np.float32) @ projection) + noise).astype(np.float32)
+
+    corpus = sample(args.size)
+    queries = sample(args.queries)
+
+    t0 = time.perf_counter()
+    index = IVFIndex.build(corpus, storage=args.storage)
+    del corpus
+    print(f"Built {index.n_lists} lists over {len(index)} vectors in {time.perf_counter() - t0:.1f}s\n")
+
+    for probes in args.probes:
+        result = measure_recall(index, queries, k=args.k, n_probe=probes)
+        print(f"n_probe={result['n_probe']:>3}  recall@{args.k}={result['recall']:.3f}  "
+              f"ann={result['ann_ms']:.3f}ms  exact={result['exact_ms']:.3f}ms")
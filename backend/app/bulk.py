@@ -0,0 +1,188 @@
+"""
+Offline bulk processing of JSONL prompt files.
+
+    python -m app.bulk prompts.jsonl results.jsonl --workers 4 --concurrency 16
+
+Each input line is a JSON object with a "prompt" (and optionally an "id"),
+or a bare JSON string. Each output line carries the input line number, the
+id, the local intent classification and report template, and the
+PromptAnalysis. Output is written in input order. Prompts that fail
+(including upstream errors) are written as {"line", "id", "error"} records
+and counted as errors, so they can be picked out and submitted again.
+
+Progress is checkpointed next to the output file. Re-running the same
+command after a crash truncates the output back to the last checkpoint and
+continues from the first unfinished line (or starts over if the output is
+missing or shorter than the checkpoint says). Only a bounded window of lines is
+in flight at once, so memory stays flat however large the input is.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+
+import orjson
+
+# Per-process instances for the CPU-bound local work (set by _init_worker)
+_classifier = None
+_template_generator = None
+
+
+def _init_worker():
+    global _classifier, _template_generator
+    from app.intent_classifier import IntentClassifier
+    from app.report_template_generator import ReportTemplateGenerator
+    _classifier = IntentClassifier()
+    _template_generator = ReportTemplateGenerator()
+
+
+def classify_and_template(prompt: str) -> Dict:
+    """Runs in the process pool: intent classification plus the matching report template."""
+    intent = _classifier.classify_intent(prompt)
+    return {'intent': intent, 'template': _template_generator.generate_template(intent, prompt)}
+
+
+def read_checkpoint(path: str, input_path: str) -> Tuple[int, int]:
+    """Returns (next input line, output byte offset) to resume from."""
+    if not os.path.exists(path):
+        return 0, 0
+    with open(path, "r", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("input") != os.path.abspath(input_path):
+        raise ValueError(f"Checkpoint {path} belongs to {checkpoint.get('input')}; use --restart to discard it")
+    return checkpoint["next_line"], checkpoint["output_offset"]
+
+
+def write_checkpoint(path: str, input_path: str, next_line: int, output_offset: int):
+    """Atomically replaces the checkpoint so a crash never leaves it half-written."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"input": os.path.abspath(input_path), "next_line": next_line,
+                   "output_offset": output_offset, "updated_at": time.time()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def iter_input(path: str, start_line: int) -> Iterator[Tuple[int, str]]:
+    """Streams (line number, raw line) pairs, skipping lines already done."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if line_no >= start_line and line.strip():
+                yield line_no, line
+
+
+def parse_record(line: str) -> Tuple[Optional[str], str]:
+    record = json.loads(line)
+    if isinstance(record, str):
+        return None, record
+    return record.get("id"), record["prompt"]
+
+
+async def run(args) -> Dict:
+    from app.prompt_engine import failure_reason, generate_systematic_prompt
+
+    checkpoint_path = args.output + ".checkpoint"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    next_line, offset = read_checkpoint(checkpoint_path, args.input)
+    output_size = os.path.getsize(args.output) if os.path.exists(args.output) else 0
+    if output_size < offset:
+        # The checkpointed output is gone (deleted or replaced); resuming would pad it with NUL bytes
+        print(f"{args.output} is shorter than its checkpoint ({output_size} < {offset} bytes); starting over")
+        next_line, offset = 0, 0
+    if next_line:
+        print(f"Resuming from input line {next_line}")
+
+    loop = asyncio.get_running_loop()
+    # Spawned, not forked: this process already runs the embedding batcher, hedger and
+    # registry threads, and a forked child would inherit their locks in whatever state they were
+    processes = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    threads = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="bulk-upstream")
+    upstream_slots = asyncio.Semaphore(args.concurrency)
+    # Bounded queue of in-order tasks: the producer blocks once `window` lines are in flight
+    in_flight = asyncio.Queue(maxsize=args.window)
+    stats = {'processed': 0, 'errors': 0, 'resumed_at': next_line}
+
+    async def process(line_no: int, line: str) -> Dict:
+        try:
+            record_id, prompt = parse_record(line)
+            local = await loop.run_in_executor(processes, classify_and_template, prompt)
+            async with upstream_slots:
+                analysis = await loop.run_in_executor(threads, generate_systematic_prompt, prompt, args.deterministic)
+            # Upstream failures and a missing API key come back as a fallback analysis, not an exception
+            error = failure_reason(analysis)
+            if error is not None:
+                return {'line': line_no, 'id': record_id, 'error': error}
+            return {'line': line_no, 'id': record_id, 'intent': local['intent'],
+                    'template': local['template'], 'analysis': analysis.model_dump()}
+        except Exception as e:
+            return {'line': line_no, 'error': f"{type(e).__name__}: {e}"}
+
+    async def produce():
+        for line_no, line in iter_input(args.input, next_line):
+            await in_flight.put((line_no, asyncio.ensure_future(process(line_no, line))))
+        await in_flight.put(None)
+
+    mode = "r+b" if os.path.exists(args.output) else "wb"
+    started = time.perf_counter()
+    with open(args.output, mode) as out:
+        # Drop anything written after the last checkpoint; those lines are redone
+        out.truncate(offset)
+        out.seek(offset)
+        producer = asyncio.ensure_future(produce())
+        since_checkpoint = 0
+        while True:
+            item = await in_flight.get()
+            if item is None:
+                break
+            line_no, task = item
+            result = await task
+            next_line = line_no + 1
+
+            out.write(orjson.dumps(result) + b"\n")
+            stats['processed'] += 1
+            stats['errors'] += 'error' in result
+            since_checkpoint += 1
+            if since_checkpoint >= args.checkpoint_every:
+                out.flush()
+                write_checkpoint(checkpoint_path, args.input, next_line, out.tell())
+                since_checkpoint = 0
+                elapsed = time.perf_counter() - started
+                print(f"  {stats['processed']} done ({stats['processed'] / elapsed:.1f}/s), next line {next_line}")
+
+        await producer
+        out.flush()
+        write_checkpoint(checkpoint_path, args.input, next_line, out.tell())
+
+    processes.shutdown()
+    threads.shutdown()
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate PromptAnalysis results for a JSONL file of prompts")
+    parser.add_argument("input", help="Input JSONL: {\"prompt\": ..., \"id\": ...} per line")
+    parser.add_argument("output", help="Output JSONL (appended to on resume)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                        help="Processes for intent classification and templates")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent upstream generations")
+    parser.add_argument("--window", type=int, default=256, help="Max lines in flight (bounds memory)")
+    parser.add_argument("--checkpoint-every", type=int, default=50, help="Lines between checkpoints")
+    parser.add_argument("--deterministic", action="store_true", help="Temperature 0 (result-cache eligible)")
+    parser.add_argument("--restart", action="store_true", help="Ignore any existing checkpoint")
+    args = parser.parse_args()
+    args.window = max(args.window, args.concurrency)
+
+    stats = asyncio.run(run(args))
+    print(f"Processed {stats['processed']} prompts ({stats['errors']} errors) in {stats['seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+
+class RequestCancelled(BaseException):
+    """
+    Raised inside a cancelled request's work. Like asyncio.CancelledError it
+    derives from BaseException, so the pipeline's `except Exception` fallbacks
+    don't turn a cancellation into an error result.
+    """
+
+
+class CancelToken:
+    """Set once when the work it guards is no longer wanted; runs registered callbacks."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks: Dict[int, Callable[[], None]] = {}
+        self._next_id = 0
+        self.cancelled = False
+
+    def cancel(self) -> bool:
+        """Cancels the token. Returns False if it was already cancelled."""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.cancelled = True
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in cancel callback: {e}")
+        return True
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Runs `callback` on cancel (now, if already cancelled). Returns a function that unregisters it."""
+        with self._lock:
+            if not self.cancelled:
+                callback_id = self._next_id
+                self._next_id += 1
+                self._callbacks[callback_id] = callback
+                return lambda: self._remove(callback_id)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback_id: int):
+        with self._lock:
+            self._callbacks.pop(callback_id, None)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise RequestCancelled()
+
+
+_current_token: ContextVar[Optional[CancelToken]] = ContextVar("cancel_token", default=None)
+
+
+def current_cancel_token() -> Optional[CancelToken]:
+    return _current_token.get()
+
+
+@contextmanager
+def cancel_scope(token: CancelToken):
+    """Makes `token` the cancel token for the work done inside the block."""
+    previous = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(previous)
+
+
+def check_cancelled():
+    """Raises RequestCancelled if the current work has been cancelled."""
+    token = _current_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def wait_cancellable(future: Future):
+    """
+    future.result(), unless the current work is cancelled first. Then the
+    future is cancelled too (a request still queued in a batch is dropped)
+    and RequestCancelled is raised without waiting for it.
+    """
+    token = _current_token.get()
+    if token is None:
+        return future.result()
+    stop = Future()
+    unregister = token.on_cancel(lambda: stop.set_result(None))
+    try:
+        wait([future, stop], return_when=FIRST_COMPLETED)
+    finally:
+        unregister()
+    if not future.done():
+        future.cancel()
+        raise RequestCancelled()
+    return future.result()
+
+
+@contextmanager
+def shielded():
+    """
+    Runs the block outside any cancel scope: for shared work (like a one-time
+    load other requests are waiting on) that one client's disconnect must not abort.
+    """
+    previous = _current_token.set(None)
+    try:
+        yield
+    finally:
+        _current_token.reset(previous)
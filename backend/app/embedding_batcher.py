@@ -0,0 +1,152 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.metrics import metrics
+
+# Upstream statuses that mean "this input was rejected" (bad request, too
+# large, unprocessable); only those are worth retrying on a smaller batch
+INPUT_ERROR_STATUSES = (400, 413, 422)
+
+
+class EmbeddingBatcher:
+    """
+    Collects embedding requests from concurrent callers and sends them upstream
+    as one multi-input call.
+
+    A batch is flushed when `window_ms` has passed since its first request, when
+    it reaches `max_batch_size`, or when the next text would take it over
+    `max_batch_tokens` (the upstream's per-request input limit), whichever
+    comes first. Batches are sent on a small thread pool so collection of the
+    next batch never waits on the network. Identical texts within a batch are
+    embedded once.
+
+    A call the upstream rejects because of its input is bisected: each half
+    is retried on its own, so one bad input fails only its own caller, not
+    everyone it happened to share a batch with. Other failures fail the
+    batch as a whole.
+    """
+
+    def __init__(self, create_fn: Callable[[List[str], str, Optional[int]], List[List[float]]],
+                 window_ms: float = 5.0, max_batch_size: int = 64, max_concurrent_batches: int = 8,
+                 max_batch_tokens: int = 200000, count_fn: Optional[Callable[[str], int]] = None):
+        self.create_fn = create_fn
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        # Without a tokenizer, ~4 characters per token
+        self.count_fn = count_fn or (lambda text: (len(text) + 3) // 4)
+        self._queue = queue.Queue()
+        self._senders = ThreadPoolExecutor(max_workers=max_concurrent_batches,
+                                           thread_name_prefix="embedding-batch")
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, text: str, model: str, dimensions: Optional[int] = None) -> Future:
+        """Queues one text; the returned future resolves to its embedding."""
+        self._ensure_worker()
+        future = Future()
+        # Counted on the caller's thread, so the collector never waits on the tokenizer
+        self._queue.put((text, model, dimensions, future, time.perf_counter(), self.count_fn(text)))
+        return future
+
+    def embed(self, text: str, model: str, dimensions: Optional[int] = None) -> List[float]:
+        return self.submit(text, model, dimensions).result()
+
+    async def embed_async(self, text: str, model: str, dimensions: Optional[int] = None) -> List[float]:
+        return await asyncio.wrap_future(self.submit(text, model, dimensions))
+
+    def _ensure_worker(self):
+        if self._worker is None:
+            with self._start_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._collect, name="embedding-batcher", daemon=True)
+                    self._worker.start()
+
+    def _collect(self):
+        carried = None
+        while True:
+            batch = [carried if carried is not None else self._queue.get()]
+            carried = None
+            tokens = batch[0][5]
+            deadline = batch[0][4] + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if tokens + item[5] > self.max_batch_tokens:
+                    # Starts the next batch instead
+                    carried = item
+                    metrics.increment("embedding_batch.token_capped")
+                    break
+                batch.append(item)
+                tokens += item[5]
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch: List[Tuple]):
+        # Requests for different models/dimensions can't share an upstream call
+        groups: Dict[Tuple[str, Optional[int]], List[Tuple]] = {}
+        for item in batch:
+            groups.setdefault((item[1], item[2]), []).append(item)
+
+        for (model, dimensions), items in groups.items():
+            live = [item for item in items if item[3].set_running_or_notify_cancel()]
+            # Callers that were cancelled while queued are simply left out of the call
+            if len(live) < len(items):
+                metrics.increment("embedding_batch.cancelled", len(items) - len(live))
+            if not live:
+                continue
+            texts = list(dict.fromkeys(item[0] for item in live))
+
+            sent_at = time.perf_counter()
+            metrics.observe("embedding_batch.size", len(live))
+            metrics.observe("embedding_batch.unique_inputs", len(texts))
+            for item in live:
+                metrics.observe("embedding_batch.queue_delay_ms", (sent_at - item[4]) * 1000)
+
+            vectors, errors = {}, {}
+            try:
+                self._embed(texts, model, dimensions, vectors, errors)
+            except Exception as e:
+                # Nobody else will resolve these futures, so a failure here must still answer every caller
+                errors.update({text: e for text in texts if text not in vectors})
+            for item in live:
+                if item[0] in vectors:
+                    item[3].set_result(vectors[item[0]])
+                else:
+                    item[3].set_exception(errors[item[0]])
+
+    def _embed(self, texts: List[str], model: str, dimensions: Optional[int],
+               vectors: Dict[str, List[float]], errors: Dict[str, Exception]):
+        """
+        Embeds texts into `vectors`. A call rejected because of its input is
+        retried as two halves; any other failure (rate limit, connection,
+        5xx, which the client has already retried with backoff) fails the
+        whole batch rather than multiplying calls to an upstream in trouble.
+        """
+        try:
+            result = self.create_fn(texts, model, dimensions)
+        except Exception as e:
+            metrics.increment("embedding_batch.errors")
+            if len(texts) == 1 or getattr(e, "status_code", None) not in INPUT_ERROR_STATUSES:
+                errors.update(dict.fromkeys(texts, e))
+                return
+            metrics.increment("embedding_batch.bisected")
+            middle = len(texts) // 2
+            self._embed(texts[:middle], model, dimensions, vectors, errors)
+            self._embed(texts[middle:], model, dimensions, vectors, errors)
+            return
+        if len(result) != len(texts):
+            metrics.increment("embedding_batch.errors")
+            errors.update(dict.fromkeys(texts, RuntimeError(
+                f"Embeddings call returned {len(result)} vectors for {len(texts)} inputs")))
+            return
+        metrics.increment("embedding_batch.calls")
+        vectors.update(zip(texts, result))
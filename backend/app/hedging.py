@@ -0,0 +1,193 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional, TypeVar
+
+from app.cancellation import CancelToken, cancel_scope, current_cancel_token
+from app.metrics import Histogram, metrics
+
+# Send a second, identical completion when the first is slower than this percentile
+# of recent completion latency. 0 disables hedging.
+COMPLETION_HEDGE_PERCENTILE = float(os.getenv("COMPLETION_HEDGE_PERCENTILE", "0"))
+# No hedging until this many latencies have been seen for the kind of request
+COMPLETION_HEDGE_MIN_SAMPLES = int(os.getenv("COMPLETION_HEDGE_MIN_SAMPLES", "50"))
+# Spend cap: hedges may add at most this fraction of extra completion requests
+COMPLETION_HEDGE_BUDGET = float(os.getenv("COMPLETION_HEDGE_BUDGET", "0.05"))
+# Concurrent hedges (primaries run on their callers' threads and aren't limited by this)
+COMPLETION_HEDGE_MAX_WORKERS = int(os.getenv("COMPLETION_HEDGE_MAX_WORKERS", "32"))
+
+# Unused budget carries over, but only up to this many hedges (bounds bursts after a quiet spell)
+HEDGE_MAX_CREDIT = 5.0
+# The trigger latency is re-derived from the recent window every this many completions
+HEDGE_REFRESH_EVERY = 32
+
+T = TypeVar("T")
+
+
+class _Race:
+    """One hedged completion: the primary attempt on the caller's thread, and at most one hedge on the pool."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.token = CancelToken()
+        self.parent = current_cancel_token()
+        # The hedge runs with the caller's context, so its usage lands in the caller's ledger row
+        self.context = contextvars.copy_context()
+        self.hedge: Optional[Future] = None
+        self.hedge_token: Optional[CancelToken] = None
+        self.winner: Optional[str] = None
+
+
+class CompletionHedger:
+    """
+    Hedged upstream completions.
+
+    The first attempt runs on the caller's thread. If it hasn't finished by
+    the configured percentile of recent latency for the same kind of
+    request, an identical second attempt is sent on a small pool (budget
+    permitting); the first to succeed wins and the other is cancelled. Only
+    hedges use the pool, so it never limits how many completions run at
+    once, and each attempt's latency is measured from when it starts
+    running. Each attempt runs under its own cancel token, linked to the
+    caller's, so a disconnect still stops both.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies: Dict[Hashable, Histogram] = {}
+        self._triggers: Dict[Hashable, Optional[float]] = {}
+        self._credit = HEDGE_MAX_CREDIT
+        self._completions = 0
+        self._hedges = 0
+        self._executor = ThreadPoolExecutor(max_workers=COMPLETION_HEDGE_MAX_WORKERS,
+                                            thread_name_prefix="completion-hedge")
+
+    @property
+    def enabled(self) -> bool:
+        return COMPLETION_HEDGE_PERCENTILE > 0
+
+    def complete(self, call: Callable[[], T], kind: Hashable) -> T:
+        """Runs `call` (one upstream completion), hedged when it is slow. `kind` groups comparable requests."""
+        if not self.enabled:
+            return call()
+
+        with self._lock:
+            self._completions += 1
+            self._credit = min(self._credit + COMPLETION_HEDGE_BUDGET, HEDGE_MAX_CREDIT)
+            trigger_ms = self._triggers.get(kind)
+
+        race = _Race()
+        timer = None
+        if trigger_ms is not None:
+            timer = threading.Timer(trigger_ms / 1000.0, self._hedge, args=(call, kind, race))
+            timer.daemon = True
+            timer.start()
+        try:
+            return self._run_primary(call, kind, race)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def _run_primary(self, call: Callable[[], T], kind: Hashable, race: _Race) -> T:
+        unlink = race.parent.on_cancel(race.token.cancel) if race.parent is not None else (lambda: None)
+        try:
+            with cancel_scope(race.token):
+                result = call()
+        except BaseException as e:
+            # Failed, or cancelled: by our caller, or by a hedge that won
+            error = e
+        else:
+            self._observe(kind, (time.perf_counter() - race.started) * 1000)
+            with race.lock:
+                won = race.winner is None
+                if won:
+                    race.winner = "primary"
+                hedge_token = race.hedge_token
+            if won and hedge_token is not None:
+                hedge_token.cancel()
+                self._record_winner(False, race, kind)
+            return result
+        finally:
+            unlink()
+
+        with race.lock:
+            if race.winner is None and race.hedge is None:
+                race.winner = "none"  # too late to hedge
+            hedge = race.hedge
+        if hedge is None or (race.parent is not None and race.parent.cancelled):
+            raise error
+        # The hedge either already won or is the remaining chance
+        result = hedge.result()
+        self._record_winner(True, race, kind)
+        return result
+
+    def _hedge(self, call: Callable[[], T], kind: Hashable, race: _Race):
+        """Timer callback: sends the hedge if the primary is still running and the budget allows."""
+        with race.lock:
+            if race.winner is not None:
+                return
+            with self._lock:
+                allowed = self._credit >= 1.0
+                if allowed:
+                    self._credit -= 1.0
+                    self._hedges += 1
+                hedge_rate = self._hedges / float(self._completions)
+            metrics.set_gauge("upstream.hedge.rate", hedge_rate)
+            if not allowed:
+                metrics.increment("upstream.hedge.skipped_budget")
+                return
+
+            metrics.increment("upstream.hedge.sent")
+            token = CancelToken()
+            race.hedge_token = token
+            race.hedge = self._executor.submit(race.context.run, self._run_hedge, call, kind, race, token)
+
+    def _run_hedge(self, call: Callable[[], T], kind: Hashable, race: _Race, token: CancelToken) -> T:
+        unlink = race.parent.on_cancel(token.cancel) if race.parent is not None else (lambda: None)
+        # Measured from here, not from submit: time queued for a pool thread isn't upstream latency
+        started = time.perf_counter()
+        try:
+            with cancel_scope(token):
+                result = call()
+        finally:
+            unlink()
+        self._observe(kind, (time.perf_counter() - started) * 1000)
+        with race.lock:
+            won = race.winner is None
+            if won:
+                race.winner = "hedge"
+        if won:
+            # Stops the primary mid-stream; its thread then returns this result
+            race.token.cancel()
+        return result
+
+    def _record_winner(self, hedge_won: bool, race: _Race, kind: Hashable):
+        if not hedge_won:
+            metrics.increment("upstream.hedge.primary_wins")
+            metrics.observe("upstream.hedge.latency_saved_ms", 0.0)
+            return
+        metrics.increment("upstream.hedge.wins")
+        # The cancelled primary would have taken at least `elapsed`; estimate its finish as the
+        # median of recent completions that took longer than that
+        elapsed = (time.perf_counter() - race.started) * 1000
+        with self._lock:
+            slower = sorted(v for v in self._latencies[kind].recent if v > elapsed)
+        if slower:
+            metrics.observe("upstream.hedge.latency_saved_ms", slower[len(slower) // 2] - elapsed)
+
+    def _observe(self, kind: Hashable, ms: float):
+        metrics.observe("upstream.completion_ms", ms)
+        with self._lock:
+            histogram = self._latencies.get(kind)
+            if histogram is None:
+                histogram = self._latencies[kind] = Histogram()
+            histogram.observe(ms)
+            if histogram.count >= COMPLETION_HEDGE_MIN_SAMPLES and (
+                    kind not in self._triggers or histogram.count % HEDGE_REFRESH_EVERY == 0):
+                self._triggers[kind] = histogram.percentile(COMPLETION_HEDGE_PERCENTILE)
+
+
+COMPLETION_HEDGER = CompletionHedger()
@@ -0,0 +1,322 @@
+"""
+Offline ingestion of a curated gold-prompt corpus into a versioned index.
+
+    python -m app.ingest corpus/*.jsonl --output-dir data/curated
+    CURATED_INDEX_PATH=data/curated/curated-<version>.npz uvicorn app.main:app
+
+Inputs are JSONL files ({"prompt": ..., "intent": "primary.sub_intent",
+"source": ...} per line) or text files with one prompt per line (labeled
+with --intent). Prompts are normalized, exact and near-duplicates are
+dropped, and the rest are embedded in large batched calls paced to stay
+under the account's request and token rate limits. Each finished batch is
+kept in a work directory, so re-running the same command after a failure
+only embeds what is missing. The result is curated-<version>.npz (the
+IVFIndex with texts, intents and sources) plus a .json manifest; serving
+only loads that artifact.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import unicodedata
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Set, Tuple
+
+import numpy as np
+
+from app.ann_index import IVFIndex, PackedStrings
+from app.quantization import EMBEDDING_DIMENSIONS, EMBEDDING_STORAGE
+from app.token_budget import EMBED_MAX_TOKENS, count_tokens
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+WORD_PATTERN = re.compile(r"\w+")
+
+# MinHash / LSH settings for near-duplicate detection (16 bands of 4 rows)
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+SHINGLE_WORDS = 3
+# Short texts, and scripts written without spaces (CJK), are shingled by characters instead
+SHINGLE_CHARS = 4
+UNSEGMENTED_WORD_CHARS = 15
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def normalize_text(text: str) -> str:
+    """NFKC plus collapsed whitespace; this is the text that gets embedded and stored."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def read_corpus(paths: List[str], default_intent: str, include_builtin: bool) -> Iterator[Dict]:
+    """Yields {'prompt', 'intent', 'source'} records in input order (earlier inputs win on duplicates)."""
+    if include_builtin:
+        from app.embeddings import iter_curated_prompts
+        for intent, prompt in iter_curated_prompts():
+            yield {'prompt': prompt, 'intent': intent, 'source': "builtin"}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                if path.endswith(".jsonl"):
+                    record = json.loads(line)
+                    yield {'prompt': record['prompt'], 'intent': record.get('intent', default_intent),
+                           'source': record.get('source', f"{path}:{line_no}")}
+                else:
+                    yield {'prompt': line, 'intent': default_intent, 'source': f"{path}:{line_no}"}
+
+
+def _shingles(text: str) -> Set[str]:
+    text = text.lower()
+    words = WORD_PATTERN.findall(text)
+    if len(words) > SHINGLE_WORDS and sum(map(len, words)) / len(words) <= UNSEGMENTED_WORD_CHARS:
+        return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    if len(text) <= SHINGLE_CHARS:
+        return {text}
+    return {text[i:i + SHINGLE_CHARS] for i in range(len(text) - SHINGLE_CHARS + 1)}
+
+
+def _minhash(shingles: Set[str], a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+                       for s in shingles], dtype=np.uint64)
+    # a < 2**31 and hashes < 2**32, so the products fit in uint64
+    return ((np.outer(hashes, a) + b) % MERSENNE_PRIME).min(axis=0)
+
+
+def find_near_duplicates(texts: List[str], threshold: float, seed: int = 0) -> Set[int]:
+    """
+    Positions of texts whose word-shingle Jaccard similarity with an earlier
+    text is at least `threshold`. MinHash LSH proposes candidate pairs; each
+    is confirmed with the exact Jaccard.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 31, MINHASH_PERMUTATIONS, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, MINHASH_PERMUTATIONS, dtype=np.uint64)
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+
+    shingle_sets = [_shingles(text) for text in texts]
+    buckets: Dict[Tuple[int, bytes], List[int]] = {}
+    duplicates = set()
+    for i, shingles in enumerate(shingle_sets):
+        signature = _minhash(shingles, a, b)
+        candidates = set()
+        for band in range(LSH_BANDS):
+            key = (band, signature[band * rows:(band + 1) * rows].tobytes())
+            candidates.update(buckets.get(key, ()))
+            buckets.setdefault(key, []).append(i)
+        for j in candidates:
+            if j in duplicates:
+                continue
+            union = len(shingles | shingle_sets[j])
+            if union and len(shingles & shingle_sets[j]) / float(union) >= threshold:
+                duplicates.add(i)
+                break
+    return duplicates
+
+
+def prepare_records(records: Iterator[Dict], near_dup_threshold: float) -> Tuple[List[Dict], Dict]:
+    """Normalizes, validates and de-duplicates. Returns (records, counts of what was dropped)."""
+    stats = {'read': 0, 'empty': 0, 'too_long': 0, 'exact_duplicates': 0, 'near_duplicates': 0}
+    kept, seen = [], set()
+    for record in records:
+        stats['read'] += 1
+        text = normalize_text(record['prompt'])
+        if not text:
+            stats['empty'] += 1
+            continue
+        if count_tokens(text) > EMBED_MAX_TOKENS:
+            stats['too_long'] += 1
+            continue
+        key = text.casefold()
+        if key in seen:
+            stats['exact_duplicates'] += 1
+            continue
+        seen.add(key)
+        intent = record['intent'] if "." in record['intent'] else f"{record['intent']}.general"
+        kept.append({'prompt': text, 'intent': intent, 'source': str(record['source'])})
+
+    if near_dup_threshold < 1.0:
+        duplicates = find_near_duplicates([r['prompt'] for r in kept], near_dup_threshold)
+        stats['near_duplicates'] = len(duplicates)
+        kept = [r for i, r in enumerate(kept) if i not in duplicates]
+    return kept, stats
+
+
+class RatePacer:
+    """Sleeps before each call as needed to stay under requests and tokens per minute."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.calls = deque()
+
+    def wait(self, tokens: int):
+        while True:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0][0] >= 60:
+                self.calls.popleft()
+            used = sum(t for _, t in self.calls)
+            if not self.calls or (len(self.calls) < self.rpm and used + tokens <= self.tpm):
+                break
+            time.sleep(max(60 - (now - self.calls[0][0]), 0.05))
+        self.calls.append((time.monotonic(), tokens))
+
+
+def _retry_after(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    header = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(header)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 60)
+
+
+def plan_batches(texts: List[str], batch_size: int, batch_tokens: int) -> List[Tuple[int, int, int]]:
+    """
+    (start, end, tokens) ranges of consecutive texts, each at most batch_size
+    texts and batch_tokens tokens. The token cap matters: an embeddings call
+    over the per-request input limit is rejected with a 400, which no retry
+    or resume gets past.
+    """
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        text_tokens = count_tokens(text)
+        if i > start and (i - start >= batch_size or tokens + text_tokens > batch_tokens):
+            batches.append((start, i, tokens))
+            start, tokens = i, 0
+        tokens += text_tokens
+    if start < len(texts):
+        batches.append((start, len(texts), tokens))
+    return batches
+
+
+def embed_batches(texts: List[str], work_dir: str, batch_size: int, batch_tokens: int,
+                  pacer: RatePacer, max_retries: int) -> np.ndarray:
+    """Embeds texts in batches, saving each finished batch; batches already on disk are skipped."""
+    import openai
+    from app.embeddings import client
+    import app.upstream as upstream
+
+    vectors = []
+    batches = plan_batches(texts, batch_size, batch_tokens)
+    n_batches = len(batches)
+    for batch_no, (start, end, tokens) in enumerate(batches):
+        path = os.path.join(work_dir, f"batch-{batch_no:05d}.npy")
+        if os.path.exists(path):
+            vectors.append(np.load(path))
+            continue
+        batch = texts[start:end]
+        for attempt in range(max_retries + 1):
+            pacer.wait(tokens)
+            try:
+                embedded = upstream.create_embeddings(client, batch, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+                break
+            except openai.RateLimitError as e:
+                if attempt == max_retries:
+                    raise
+                delay = _retry_after(e, attempt)
+                print(f"  rate limited on batch {batch_no}, retrying in {delay:.0f}s")
+                time.sleep(delay)
+        array = np.array(embedded, dtype=np.float32)
+        # Write then rename so an interrupted save never looks like a finished batch
+        np.save(path + ".tmp.npy", array)
+        os.replace(path + ".tmp.npy", path)
+        vectors.append(array)
+        print(f"  embedded batch {batch_no + 1}/{n_batches} ({len(batch)} prompts, ~{tokens} tokens)")
+    return np.concatenate(vectors) if vectors else np.empty((0, EMBEDDING_DIMENSIONS or 0), dtype=np.float32)
+
+
+def _open_work_dir(work_dir: str, records: List[Dict], batch_size: int, batch_tokens: int) -> None:
+    """Reuses the work dir only if it was started for exactly these records and batching."""
+    listing = "".join(json.dumps(r, sort_keys=True) + "\n" for r in records)
+    settings = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}:{batch_size}:{batch_tokens}"
+    digest = hashlib.sha256(f"{settings}\n{listing}".encode("utf-8")).hexdigest()
+    marker = os.path.join(work_dir, "records.sha256")
+    if os.path.exists(marker):
+        with open(marker, "r", encoding="utf-8") as f:
+            if f.read().strip() == digest:
+                print(f"Resuming from {work_dir}")
+                return
+        print(f"Inputs changed since {work_dir} was started; starting over")
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    with open(marker, "w", encoding="utf-8") as f:
+        f.write(digest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a versioned curated-prompt index from gold prompt files")
+    parser.add_argument("inputs", nargs="*", help="JSONL ({\"prompt\", \"intent\", \"source\"}) or text files")
+    parser.add_argument("--output-dir", default="data/curated")
+    parser.add_argument("--version", default=None, help="Artifact version (default: UTC timestamp)")
+    parser.add_argument("--intent", default="general.general", help="Intent for text inputs and unlabeled records")
+    parser.add_argument("--include-builtin", action="store_true", help="Also ingest CURATED_PROMPTS")
+    parser.add_argument("--near-dup-threshold", type=float, default=0.8,
+                        help="Word-shingle Jaccard at or above which a prompt counts as a near-duplicate (1 disables)")
+    parser.add_argument("--batch-size", type=int, default=512, help="Inputs per embeddings call (API max 2048)")
+    parser.add_argument("--batch-tokens", type=int, default=200000,
+                        help="Input tokens per embeddings call (API max 300000)")
+    parser.add_argument("--rpm", type=int, default=500, help="Embedding requests per minute")
+    parser.add_argument("--tpm", type=int, default=1000000, help="Embedding tokens per minute")
+    parser.add_argument("--max-retries", type=int, default=8, help="Retries per batch when rate limited")
+    parser.add_argument("--keep-work", action="store_true", help="Keep the per-batch work directory")
+    args = parser.parse_args()
+    if not args.inputs and not args.include_builtin:
+        parser.error("give input files and/or --include-builtin")
+
+    version = args.version or datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    records, stats = prepare_records(read_corpus(args.inputs, args.intent, args.include_builtin),
+                                     args.near_dup_threshold)
+    print(f"Read {stats['read']} prompts; kept {len(records)} "
+          f"(dropped {stats['exact_duplicates']} exact and {stats['near_duplicates']} near duplicates, "
+          f"{stats['empty']} empty, {stats['too_long']} too long)")
+    if not records:
+        raise SystemExit("Nothing to ingest")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    work_dir = os.path.join(args.output_dir, ".ingest-work")
+    _open_work_dir(work_dir, records, args.batch_size, args.batch_tokens)
+    started = time.perf_counter()
+    vectors = embed_batches([r['prompt'] for r in records], work_dir, args.batch_size, args.batch_tokens,
+                            RatePacer(args.rpm, args.tpm), args.max_retries)
+
+    index = IVFIndex.build(vectors, storage=EMBEDDING_STORAGE, metadata={
+        "texts": PackedStrings.from_list([r['prompt'] for r in records]),
+        "intents": np.array([r['intent'] for r in records]),
+        "sources": PackedStrings.from_list([r['source'] for r in records]),
+        "version": np.array(version)
+    })
+    index_path = os.path.join(args.output_dir, f"curated-{version}.npz")
+    index.save(index_path)
+
+    intents: Dict[str, int] = {}
+    for record in records:
+        intents[record['intent']] = intents.get(record['intent'], 0) + 1
+    manifest = {
+        'version': version,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'index': os.path.basename(index_path),
+        'model': EMBEDDING_MODEL,
+        'dimensions': int(index.dimensions),
+        'storage': EMBEDDING_STORAGE,
+        'count': len(records),
+        'intents': intents,
+        'inputs': args.inputs + (["builtin"] if args.include_builtin else []),
+        'dropped': stats,
+        'embed_seconds': round(time.perf_counter() - started, 1)
+    }
+    with open(os.path.join(args.output_dir, f"curated-{version}.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    if not args.keep_work:
+        shutil.rmtree(work_dir)
+
+    print(f"Wrote {len(records)} prompts to {index_path}")
+    print(f"Serve it with CURATED_INDEX_PATH={index_path}")
+
+
+if __name__ == "__main__":
+    main()
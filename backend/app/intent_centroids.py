@@ -0,0 +1,84 @@
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+
+from app.quantization import CompactVectors, normalize_rows
+
+
+class IntentCentroidIndex:
+    """
+    One unit centroid per "primary.sub_intent", averaged from labeled exemplar
+    embeddings. Classifying a prompt embedding is a single matrix-vector
+    product against all centroids.
+    """
+
+    def __init__(self, labels: List[str], centroids: np.ndarray, counts: Optional[np.ndarray] = None):
+        self.labels = labels
+        self.centroids = centroids
+        self.counts = counts if counts is not None else np.ones(len(labels), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @classmethod
+    def build(cls, vectors, labels: Sequence[str]) -> "IntentCentroidIndex":
+        vectors = normalize_rows(vectors)
+        labels = [str(label) for label in labels]
+        names = list(dict.fromkeys(labels))
+        positions = {name: i for i, name in enumerate(names)}
+        assignment = np.array([positions[label] for label in labels])
+
+        sums = np.zeros((len(names), vectors.shape[1]), dtype=np.float32)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=len(names))
+        return cls(names, normalize_rows(sums), counts)
+
+    @classmethod
+    def from_compact(cls, vectors: CompactVectors, labels: Sequence[str],
+                     order: Optional[np.ndarray] = None) -> "IntentCentroidIndex":
+        """
+        Same as build() over vectors kept in a compact format, decoding one
+        slice at a time so the corpus is never expanded to float32 as a whole.
+        Stored row i has label labels[order[i]] (an IVFIndex stores its rows
+        grouped by list; pass its `ids`).
+        """
+        labels = [str(label) for label in labels]
+        names = list(dict.fromkeys(labels))
+        positions = {name: i for i, name in enumerate(names)}
+        assignment = np.array([positions[label] for label in labels])
+        if order is not None:
+            assignment = assignment[order]
+
+        sums = np.zeros((len(names), vectors.dimensions), dtype=np.float32)
+        for start, rows in vectors.iter_slices():
+            np.add.at(sums, assignment[start:start + len(rows)], normalize_rows(rows))
+        counts = np.bincount(assignment, minlength=len(names))
+        return cls(names, normalize_rows(sums), counts)
+
+    def classify(self, embedding, top_n: int = 3) -> Dict:
+        """
+        Returns: {
+            'intent': "primary.sub_intent",
+            'primary_intent': str,
+            'sub_intent': str,
+            'score': float,      # cosine to the winning centroid
+            'margin': float,     # lead over the runner-up
+            'ranking': [(label, score), ...]   # top_n labels
+        }
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        if query.shape[-1] > self.centroids.shape[1]:
+            query = query[:self.centroids.shape[1]]
+        scores = self.centroids @ normalize_rows(query)
+        order = np.argsort(-scores)[:max(top_n, 2)]
+
+        best = self.labels[order[0]]
+        primary, _, sub = best.partition(".")
+        runner_up = float(scores[order[1]]) if len(order) > 1 else 0.0
+        return {
+            'intent': best,
+            'primary_intent': primary,
+            'sub_intent': sub or primary,
+            'score': float(scores[order[0]]),
+            'margin': float(scores[order[0]]) - runner_up,
+            'ranking': [(self.labels[i], float(scores[i])) for i in order[:top_n]]
+        }
@@ -0,0 +1,151 @@
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.metrics import metrics
+from app.pattern_matcher import KeywordAutomaton
+
+# Versioned pattern config; edits are picked up without a redeploy
+INTENT_PATTERNS_PATH = os.getenv(
+    "INTENT_PATTERNS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_patterns.json")
+)
+INTENT_PATTERNS_POLL_SECONDS = float(os.getenv("INTENT_PATTERNS_POLL_SECONDS", "5"))
+
+# Points per match, by pattern kind
+PATTERN_WEIGHTS = {
+    "keywords": 1.0,
+    "phrases": 3.0,
+    "indicators": 2.0
+}
+
+
+class CompiledPatterns:
+    """Immutable snapshot of one pattern config version, ready for matching."""
+
+    def __init__(self, config: Dict, build_ms: float = 0.0):
+        self.version = str(config.get("version", "unversioned"))
+        self.intent_patterns = config["intent_patterns"]
+        self.stakeholder_patterns = config.get("stakeholder_patterns", [])
+        self.data_context_patterns = config.get("data_context_patterns", {"has_data": [], "needs_data": []})
+        self.build_ms = build_ms
+
+        # Every "primary.sub_intent" in config order (ties resolve to the earliest)
+        self.labels: List[str] = []
+        # term -> [(label index, weight), ...]; a term listed twice scores twice
+        term_weights: Dict[str, List[Tuple[int, float]]] = {}
+        for primary, sub_intents in self.intent_patterns.items():
+            for sub_intent, patterns in sub_intents.items():
+                label_id = len(self.labels)
+                self.labels.append(f"{primary}.{sub_intent}")
+                for kind, weight in PATTERN_WEIGHTS.items():
+                    for term in patterns.get(kind, []):
+                        term_weights.setdefault(term, []).append((label_id, weight))
+
+        terms = list(term_weights)
+        self.automaton = KeywordAutomaton(terms)
+        self.term_weights = [term_weights[term] for term in terms]
+
+        self.stakeholder_regexes = [re.compile(p) for p in self.stakeholder_patterns]
+        self.has_data_regexes = [re.compile(p) for p in self.data_context_patterns.get("has_data", [])]
+        self.needs_data_regexes = [re.compile(p) for p in self.data_context_patterns.get("needs_data", [])]
+
+    def score(self, query: str) -> Dict[str, float]:
+        """Scores every sub-intent for an already-lowercased query in one pass."""
+        return self.score_terms(self.automaton.find(query))
+
+    def score_terms(self, term_ids) -> Dict[str, float]:
+        """Scores every sub-intent from the pattern terms found in a query."""
+        scores = [0.0] * len(self.labels)
+        for term_id in term_ids:
+            for label_id, weight in self.term_weights[term_id]:
+                scores[label_id] += weight
+        return dict(zip(self.labels, scores))
+
+
+def build_patterns(path: str) -> CompiledPatterns:
+    start = time.perf_counter()
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    compiled = CompiledPatterns(config)
+    compiled.build_ms = (time.perf_counter() - start) * 1000
+    return compiled
+
+
+class IntentPatternRegistry:
+    """
+    Holds the active CompiledPatterns and rebuilds them off the request path.
+
+    A daemon thread polls the config file's mtime; on change it builds a new
+    snapshot and swaps it in with a single reference assignment, so readers
+    always see either the old or the new version, never a partial one. A
+    broken config is reported and the previous version stays active.
+    """
+
+    def __init__(self, path: str = INTENT_PATTERNS_PATH, poll_seconds: float = INTENT_PATTERNS_POLL_SECONDS):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self._mtime = os.stat(path).st_mtime
+        self._current = build_patterns(path)
+        self._publish(self._current)
+        self._watcher = None
+
+    @property
+    def current(self) -> CompiledPatterns:
+        return self._current
+
+    def start(self):
+        if self._watcher is None and self.poll_seconds > 0:
+            self._watcher = threading.Thread(target=self._watch, name="intent-pattern-watcher", daemon=True)
+            self._watcher.start()
+        return self
+
+    def reload(self) -> bool:
+        """Rebuilds if the file changed. Returns True when a new version was swapped in."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        # Remember the attempt even if it fails, so a broken file is reported once
+        self._mtime = mtime
+
+        try:
+            compiled = build_patterns(self.path)
+        except (OSError, ValueError, KeyError, re.error) as e:
+            metrics.increment("intent_patterns.reload_errors")
+            print(f"Error reloading intent patterns from {self.path}: {e}")
+            return False
+
+        self._current = compiled
+        self._publish(compiled)
+        print(f"Loaded intent patterns version {compiled.version} in {compiled.build_ms:.1f}ms")
+        return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            self.reload()
+
+    def _publish(self, compiled: CompiledPatterns):
+        metrics.set_gauge("intent_patterns.version", compiled.version)
+        metrics.set_gauge("intent_patterns.build_ms", compiled.build_ms)
+        metrics.increment("intent_patterns.loads")
+
+
+_default_registry: Optional[IntentPatternRegistry] = None
+_default_lock = threading.Lock()
+
+
+def get_registry() -> IntentPatternRegistry:
+    """Shared registry for the process, started on first use."""
+    global _default_registry
+    if _default_registry is None:
+        with _default_lock:
+            if _default_registry is None:
+                _default_registry = IntentPatternRegistry().start()
+    return _default_registry
@@ -0,0 +1,219 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+import uuid
+from typing import Callable, Dict, Optional
+
+from app.metrics import metrics
+from app.sqlite_store import WALDatabase, open_optional
+
+# Persistent queue for POST /jobs, shared by every worker process on the host. Set JOBS_DB_PATH="" to disable.
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "data/jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Delay before retry n is JOB_RETRY_BACKOFF_SECONDS * 2 ** (n - 1)
+JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "5"))
+# A running job whose worker died (crash, restart) is picked up again after this long
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Finished jobs are deleted after this long
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# Optional local endpoint that receives {"id", "status", "result"/"error"} when a job finishes
+JOB_CALLBACK_URL = os.getenv("JOB_CALLBACK_URL", "")
+JOB_CALLBACK_TIMEOUT_SECONDS = float(os.getenv("JOB_CALLBACK_TIMEOUT_SECONDS", "5"))
+
+# Idle workers re-check the table this often (retries coming due, jobs queued by other processes)
+POLL_SECONDS = 1.0
+CLEANUP_EVERY_SECONDS = 3600
+
+
+class JobFailed(Exception):
+    """Raised by a job handler for a failed attempt (it will be retried while attempts remain)."""
+
+
+class JobQueue:
+    """
+    SQLite-backed job queue with a pool of worker threads.
+
+    A worker claims the oldest due job inside an IMMEDIATE transaction, so
+    concurrent workers, in this process or others, never run the same job
+    twice at once. A claim is a lease: if the worker dies, the job becomes
+    claimable again once the lease expires. Failed attempts are retried
+    with exponential backoff up to JOB_MAX_ATTEMPTS; a job whose lease
+    expires on its last attempt is marked failed.
+    """
+
+    def __init__(self, path: str, handler: Callable[[Dict], Dict], workers: int = JOB_WORKERS):
+        self.path = path
+        self.handler = handler
+        self.workers = workers
+        self._wake = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._last_cleanup = 0.0
+        self._db = WALDatabase(path, (
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT NOT NULL, payload TEXT NOT NULL,"
+            " result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0,"
+            " run_after REAL NOT NULL, lease_until REAL, callback INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_after)"
+        ), timeout=10.0)
+
+    def start(self) -> "JobQueue":
+        with self._start_lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        return self
+
+    def submit(self, payload: Dict, callback: bool = False) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._db.connect().execute(
+            "INSERT INTO jobs (id, status, payload, run_after, callback, created_at, updated_at)"
+            " VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, json.dumps(payload), now, int(callback), now, now)
+        )
+        metrics.increment("jobs.submitted")
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._db.connect().execute(
+            "SELECT id, status, attempts, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = {'id': row[0], 'status': row[1], 'attempts': row[2], 'created_at': row[5], 'updated_at': row[6]}
+        if row[3] is not None:
+            job['result'] = json.loads(row[3])
+        if row[4] is not None:
+            job['error'] = row[4]
+        return job
+
+    def _claim(self) -> Optional[tuple]:
+        conn = self._db.connect()
+        now = time.time()
+        lost_error = f"Lease expired on all {JOB_MAX_ATTEMPTS} attempts"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # A job whose lease ran out on every attempt (it keeps crashing or killing
+            # its worker) is failed rather than handed to yet another worker
+            lost = conn.execute(
+                "SELECT id, callback FROM jobs WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, JOB_MAX_ATTEMPTS)
+            ).fetchall()
+            for job_id, _ in lost:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                    (lost_error, now, job_id)
+                )
+            row = conn.execute(
+                "SELECT id, payload, attempts, callback, created_at FROM jobs"
+                " WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until < ?)"
+                " ORDER BY run_after LIMIT 1", (now, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ?"
+                    " WHERE id = ?", (now + JOB_LEASE_SECONDS, now, row[0])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for job_id, callback in lost:
+            print(f"Job {job_id} failed: {lost_error}")
+            metrics.increment("jobs.failed")
+            if callback:
+                self._notify({'id': job_id, 'status': 'failed', 'error': lost_error})
+        return row
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._run(*job)
+                    continue
+            except Exception as e:
+                # Keep the worker alive; a job it had claimed is picked up again when its lease expires
+                print(f"Error in job worker: {e}")
+                metrics.increment("jobs.worker_errors")
+            self._cleanup()
+            self._wake.wait(POLL_SECONDS)
+            self._wake.clear()
+
+    def _run(self, job_id: str, payload: str, attempts: int, callback: int, created_at: float):
+        attempt = attempts + 1
+        if attempt == 1:
+            metrics.observe("jobs.queue_delay_ms", (time.time() - created_at) * 1000)
+        start = time.perf_counter()
+        try:
+            result = self.handler(json.loads(payload))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            metrics.observe("jobs.run_ms", (time.perf_counter() - start) * 1000)
+            if attempt < JOB_MAX_ATTEMPTS:
+                metrics.increment("jobs.retried")
+                self._finish(job_id, "queued", error=error,
+                             run_after=time.time() + JOB_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+                return
+            print(f"Job {job_id} failed after {attempt} attempts: {error}")
+            metrics.increment("jobs.failed")
+            self._finish(job_id, "failed", error=error)
+            if callback:
+                self._notify({'id': job_id, 'status': 'failed', 'error': error})
+            return
+
+        metrics.observe("jobs.run_ms", (time.perf_counter() - start) * 1000)
+        metrics.increment("jobs.succeeded")
+        self._finish(job_id, "succeeded", result=json.dumps(result))
+        if callback:
+            self._notify({'id': job_id, 'status': 'succeeded', 'result': result})
+
+    def _finish(self, job_id: str, status: str, result: Optional[str] = None,
+                error: Optional[str] = None, run_after: Optional[float] = None):
+        now = time.time()
+        self._db.connect().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, run_after = COALESCE(?, run_after),"
+            " lease_until = NULL, updated_at = ? WHERE id = ?",
+            (status, result, error, run_after, now, job_id)
+        )
+
+    def _notify(self, body: Dict):
+        if not JOB_CALLBACK_URL:
+            return
+        request = urllib.request.Request(JOB_CALLBACK_URL, data=json.dumps(body).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=JOB_CALLBACK_TIMEOUT_SECONDS):
+                pass
+            metrics.increment("jobs.callbacks_sent")
+        except Exception as e:
+            print(f"Error sending callback for job {body['id']}: {e}")
+            metrics.increment("jobs.callback_errors")
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < CLEANUP_EVERY_SECONDS:
+            return
+        self._last_cleanup = now
+        try:
+            deleted = self._db.connect().execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?",
+                (now - JOB_RETENTION_SECONDS,)
+            ).rowcount
+            metrics.increment("jobs.expired", deleted)
+        except sqlite3.Error as e:
+            print(f"Error cleaning up jobs: {e}")
+
+
+def open_job_queue(handler: Callable[[Dict], Dict]) -> Optional[JobQueue]:
+    return open_optional("Job queue", JOBS_DB_PATH, lambda path: JobQueue(path, handler))
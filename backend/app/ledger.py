@@ -0,0 +1,202 @@
+"""
+Append-only ledger of what each generation cost upstream.
+
+One row per upstream-backed operation: each generate_systematic_prompt
+call, refinement round and section regeneration ('kind'). A row holds the
+intent and sub-intent, similarity, model, prompt/completion/cached tokens,
+stage latencies, and how it was served (result cache, local pre-filter,
+intent from the embedding). Rows go to a local SQLite file (LEDGER_PATH) that is
+never updated in place.
+
+    python -m app.ledger --by intent
+    python -m app.ledger --by day --since-days 7
+    python -m app.ledger --by kind
+
+aggregates the ledger, showing where tokens and latency go and how often
+the cache and the local fast paths avoid them.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from app.cancellation import RequestCancelled
+from app.metrics import metrics
+from app.profiling import current_profile, profile_request
+from app.sqlite_store import WALDatabase, open_optional
+
+# Shared by every worker on the host. Set LEDGER_PATH="" to disable.
+LEDGER_PATH = os.getenv("LEDGER_PATH", "data/ledger.sqlite3")
+
+COLUMNS = (
+    "ts", "day", "intent", "sub_intent", "similarity", "is_vague", "similarity_source",
+    "intent_source", "model", "prompt_tokens", "completion_tokens", "cached_tokens",
+    "upstream_calls", "cache", "outcome", "total_ms", "upstream_ms", "embedding_ms", "stages", "kind"
+)
+
+
+class Ledger:
+    """SQLite (WAL) table of ledger rows, one connection per thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = WALDatabase(path, (
+            "CREATE TABLE IF NOT EXISTS ledger ("
+            " ts REAL NOT NULL, day TEXT NOT NULL, intent TEXT, sub_intent TEXT, similarity REAL,"
+            " is_vague INTEGER, similarity_source TEXT, intent_source TEXT, model TEXT,"
+            " prompt_tokens INTEGER NOT NULL DEFAULT 0, completion_tokens INTEGER NOT NULL DEFAULT 0,"
+            " cached_tokens INTEGER NOT NULL DEFAULT 0, upstream_calls INTEGER NOT NULL DEFAULT 0,"
+            " cache TEXT, outcome TEXT NOT NULL, total_ms REAL, upstream_ms REAL, embedding_ms REAL,"
+            " stages TEXT, kind TEXT)",
+            "CREATE INDEX IF NOT EXISTS ledger_day ON ledger (day)"
+        ))
+        conn = self._db.connect()
+        if "kind" not in {row[1] for row in conn.execute("PRAGMA table_info(ledger)")}:
+            # Ledgers written before refinement calls were recorded; their rows are all generations
+            try:
+                conn.execute("ALTER TABLE ledger ADD COLUMN kind TEXT")
+            except sqlite3.OperationalError:
+                pass  # another process added it first
+
+    def append(self, row: Dict):
+        start = time.perf_counter()
+        self._db.connect().execute(
+            f"INSERT INTO ledger ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+            tuple(row.get(column) for column in COLUMNS)
+        )
+        metrics.observe("ledger.append_ms", (time.perf_counter() - start) * 1000)
+
+    def report(self, by: str = "intent", since_days: Optional[float] = None) -> List[Dict]:
+        """One row of totals and averages per intent, kind or day; most tokens first (newest day first)."""
+        group = {"intent": "COALESCE(intent, '-')", "kind": "COALESCE(kind, 'generate')", "day": "day"}[by]
+        where, params = "", ()
+        if since_days is not None:
+            where, params = "WHERE ts >= ?", (time.time() - since_days * 86400,)
+        rows = self._db.connect().execute(
+            f"SELECT {group}, COUNT(*),"
+            " SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens), SUM(upstream_calls),"
+            " AVG(total_ms), AVG(CASE WHEN upstream_calls > 0 THEN upstream_ms END),"
+            " SUM(cache = 'hit'), SUM(similarity_source = 'prefilter'),"
+            " SUM(intent_source = 'embedding'), SUM(outcome != 'ok')"
+            f" FROM ledger {where} GROUP BY 1"
+            f" ORDER BY {'1 DESC' if by == 'day' else 'SUM(prompt_tokens + completion_tokens) DESC'}",
+            params
+        ).fetchall()
+        return [{
+            by: row[0],
+            'requests': row[1],
+            'prompt_tokens': row[2] or 0,
+            'completion_tokens': row[3] or 0,
+            'cached_tokens': row[4] or 0,
+            'upstream_calls': row[5] or 0,
+            'tokens_per_request': ((row[2] or 0) + (row[3] or 0)) / float(row[1]),
+            'mean_total_ms': row[6] or 0.0,
+            'mean_upstream_ms': row[7] or 0.0,
+            'cache_hit_rate': (row[8] or 0) / float(row[1]),
+            'prefilter_rate': (row[9] or 0) / float(row[1]),
+            'embedding_intent_rate': (row[10] or 0) / float(row[1]),
+            'errors': row[11] or 0
+        } for row in rows]
+
+
+LEDGER = open_optional("Ledger", LEDGER_PATH, Ledger)
+
+_current_entry: ContextVar[Optional[Dict]] = ContextVar("ledger_entry", default=None)
+# A hedged completion's attempts add to the same row from two threads
+_usage_lock = threading.Lock()
+
+
+@contextmanager
+def ledger_entry(kind: str = "generate"):
+    """
+    Collects one ledger row for the work done inside the block and appends it
+    at the end. `kind` names the operation ("generate", "refine",
+    "regenerate_section"). Stage latencies come from the request profile, so one is
+    started here when the request isn't already being profiled.
+    """
+    if LEDGER is None:
+        yield None
+        return
+    entry = {'kind': kind, 'outcome': 'ok', 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0,
+             'upstream_calls': 0}
+    token = _current_entry.set(entry)
+    started = time.perf_counter()
+    try:
+        profile = current_profile()
+        if profile is not None:
+            first_stage = len(profile.stages)
+            yield entry
+        else:
+            with profile_request() as profile:
+                first_stage = 0
+                yield entry
+    except RequestCancelled:
+        entry['outcome'] = 'cancelled'
+        raise
+    except Exception:
+        entry['outcome'] = 'error'
+        raise
+    finally:
+        _current_entry.reset(token)
+        stages: Dict[str, float] = {}
+        for name, ms in profile.stages[first_stage:]:
+            stages[name] = stages.get(name, 0.0) + ms
+        now = time.time()
+        entry.update(ts=now, day=time.strftime("%Y-%m-%d", time.gmtime(now)),
+                     total_ms=(time.perf_counter() - started) * 1000,
+                     upstream_ms=stages.get('upstream'), embedding_ms=stages.get('embedding'),
+                     stages=json.dumps({name: round(ms, 3) for name, ms in stages.items()}))
+        try:
+            LEDGER.append(entry)
+        except sqlite3.Error as e:
+            print(f"Error appending to ledger: {e}")
+            metrics.increment("ledger.errors")
+
+
+def note(**fields):
+    """Sets fields of the current ledger row, if one is being collected."""
+    entry = _current_entry.get()
+    if entry is not None:
+        entry.update(fields)
+
+
+def record_usage(model: str, usage: Optional[Dict]):
+    """Adds one upstream completion's token usage to the current ledger row."""
+    entry = _current_entry.get()
+    if entry is None:
+        return
+    with _usage_lock:
+        entry['model'] = model
+        entry['upstream_calls'] += 1
+        if usage:
+            entry['prompt_tokens'] += usage.get('prompt_tokens') or 0
+            entry['completion_tokens'] += usage.get('completion_tokens') or 0
+            entry['cached_tokens'] += usage.get('cached_tokens') or 0
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Upstream tokens and latency per intent, kind or day")
+    parser.add_argument("--by", choices=["intent", "kind", "day"], default="intent")
+    parser.add_argument("--since-days", type=float, default=None, help="Only rows from the last N days")
+    parser.add_argument("--json", action="store_true", help="Print the rows as JSON")
+    args = parser.parse_args()
+
+    if LEDGER is None:
+        raise SystemExit("Ledger is disabled (LEDGER_PATH is empty or not writable)")
+    report = LEDGER.report(args.by, args.since_days)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{args.by:<16} {'reqs':>6} {'prompt':>9} {'compl':>8} {'cached':>8} {'tok/req':>8} "
+              f"{'total ms':>9} {'upstr ms':>9} {'cache':>6} {'prefil':>6} {'emb-int':>7} {'errors':>6}")
+        for row in report:
+            print(f"{str(row[args.by])[:16]:<16} {row['requests']:>6} {row['prompt_tokens']:>9} "
+                  f"{row['completion_tokens']:>8} {row['cached_tokens']:>8} {row['tokens_per_request']:>8.0f} "
+                  f"{row['mean_total_ms']:>9.0f} {row['mean_upstream_ms']:>9.0f} {row['cache_hit_rate']:>6.0%} "
+                  f"{row['prefilter_rate']:>6.0%} {row['embedding_intent_rate']:>7.0%} {row['errors']:>6}")
@@ -1,9 +1,36 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+import orjson
+from fastapi import FastAPI, Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from app.prompt_engine import generate_systematic_prompt, PromptAnalysis
+from typing import Dict, List, Optional
+from app.prompt_engine import failure_reason, generate_systematic_prompt, PromptAnalysis
+from app.metrics import metrics
+from app.profiling import is_admin_key, profile_request, stage
+from app.refinement import RefinementSession, regenerate_section
+from app.prefetch import PREFETCHER
+from app.cancellation import CancelToken, RequestCancelled, cancel_scope, wait_cancellable
+from app.jobs import JobFailed, open_job_queue
 
-app = FastAPI(title="AI Prompt Studio API")
+# Responses larger than this many bytes are gzip-compressed (when the client accepts it)
+RESPONSE_GZIP_MIN_BYTES = int(os.getenv("RESPONSE_GZIP_MIN_BYTES", "1024"))
+# How often a running generation checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.25"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Resume jobs left queued (or interrupted) by a previous run
+    if JOB_QUEUE:
+        JOB_QUEUE.start()
+    yield
+
+app = FastAPI(title="AI Prompt Studio API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # CORS setup
 app.add_middleware(
@@ -13,20 +40,241 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=RESPONSE_GZIP_MIN_BYTES)
 
 class PromptRequest(BaseModel):
     prompt: str
+    # Optional: return only these PromptAnalysis fields
+    fields: Optional[List[str]] = None
+    # Optional: drop enhanced_prompt (it repeats structured_prompt as markdown)
+    compact: bool = False
+    # Optional: temperature 0 output, served from the result cache when available
+    deterministic: bool = False
+
+def render_analysis(analysis: PromptAnalysis, fields: Optional[List[str]] = None, compact: bool = False) -> Response:
+    """Serializes a PromptAnalysis with orjson, recording encode cost and payload size."""
+    start = time.perf_counter()
+    if fields:
+        payload = analysis.model_dump(include=set(fields))
+    elif compact:
+        payload = analysis.model_dump(exclude={"enhanced_prompt"})
+    else:
+        payload = analysis.model_dump()
+    body = orjson.dumps(payload)
+    encode_ms = (time.perf_counter() - start) * 1000
+
+    metrics.observe("response.encode_ms", encode_ms)
+    metrics.observe("response.bytes", len(body))
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"X-Encode-Time-Ms": f"{encode_ms:.3f}", "X-Payload-Bytes": str(len(body))}
+    )
+
+class PrefetchRequest(BaseModel):
+    prompt: str
+    # Identifies the editor/draft so a newer draft cancels work for the older one
+    session_id: Optional[str] = None
+    # Also start the completion speculatively (subject to the speculative budget)
+    speculate: bool = False
+    deterministic: bool = False
+
+class RegenerateSectionRequest(BaseModel):
+    # The analysis the user is looking at (as returned by /generate)
+    analysis: PromptAnalysis
+    # "situation", "task", "objective", "knowledge" or "suggestions"
+    section: str
+    # Optional: what the user wants changed about it
+    instructions: Optional[str] = None
+
+class JobRequest(BaseModel):
+    prompt: str
+    deterministic: bool = False
+    # Optional: POST the finished job to the configured JOB_CALLBACK_URL
+    callback: bool = False
 
 # Root route (for testing)
 @app.get("/")
 def read_root():
     return {"message": "Welcome to AI Prompt Studio Backend! 🚀"}
 
+# In-process metrics (batching, caches, latencies)
+@app.get("/metrics")
+def read_metrics():
+    return metrics.snapshot()
+
 # Generation route
+def run_generation(request: PromptRequest) -> PromptAnalysis:
+    """Generates, reusing anything /prefetch already computed for this exact prompt."""
+    prefetched = PREFETCHER.take(request.prompt, deterministic=request.deterministic)
+    if prefetched is not None and prefetched.completion is not None:
+        try:
+            analysis = wait_cancellable(prefetched.completion)
+            # Generated from the draft, which may differ from this request in whitespace
+            analysis.original_prompt = request.prompt
+            return analysis
+        except RequestCancelled:
+            # Our client went away; nobody will read the speculative result either
+            prefetched.cancel_token.cancel()
+            raise
+        except Exception as e:
+            print(f"Speculative generation failed, regenerating: {e}")
+    return generate_systematic_prompt(
+        request.prompt,
+        deterministic=request.deterministic,
+        precomputed_similarity=prefetched.similarity if prefetched is not None else None
+    )
+
+# Debounced calls from the editor while the user types
+@app.post("/prefetch")
+def prefetch_prompt_api(request: PrefetchRequest):
+    if not request.prompt.strip():
+        raise HTTPException(status_code=400, detail="Prompt cannot be empty")
+    return PREFETCHER.prefetch(request.prompt, session_id=request.session_id,
+                               speculate=request.speculate, deterministic=request.deterministic)
+
+async def run_until_disconnect(http_request: Request, fn, *args) -> Response:
+    """
+    Runs fn(*args) on the threadpool inside a cancel scope and polls the
+    client meanwhile. If the client disconnects, the scope is cancelled: the
+    upstream embedding and completion calls in flight are dropped, the worker
+    thread is freed, and a 499 is logged instead of a response.
+    """
+    token = CancelToken()
+
+    def call():
+        with cancel_scope(token):
+            return fn(*args)
+
+    work = asyncio.ensure_future(run_in_threadpool(call))
+    started = time.perf_counter()
+    while not work.done():
+        await asyncio.wait({work}, timeout=DISCONNECT_POLL_SECONDS)
+        if not work.done() and await http_request.is_disconnected():
+            token.cancel()
+            metrics.increment("requests.cancelled_on_disconnect")
+            break
+    try:
+        return await work
+    except RequestCancelled:
+        # Time the worker would otherwise have spent waiting is what the cancellation recovers
+        metrics.observe("requests.cancelled_after_ms", (time.perf_counter() - started) * 1000)
+        return Response(status_code=499)
+
+def handle_generate(request: PromptRequest, x_profile: Optional[str], x_admin_key: Optional[str]) -> Response:
+    if not request.prompt.strip():
+        raise HTTPException(status_code=400, detail="Prompt cannot be empty")
+    if request.fields:
+        unknown = set(request.fields) - set(PromptAnalysis.model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    if x_profile:
+        if not is_admin_key(x_admin_key):
+            raise HTTPException(status_code=403, detail="Profiling requires an admin key")
+        with profile_request(capture=x_profile.lower() == "capture") as profile:
+            analysis = run_generation(request)
+            with stage("encode"):
+                response = render_analysis(analysis, request.fields, request.compact)
+        response.headers["Server-Timing"] = profile.server_timing()
+        response.headers["X-Profile-Id"] = profile.id
+        if profile.capture_path:
+            response.headers["X-Profile-Path"] = profile.capture_path
+        return response
+
+    analysis = run_generation(request)
+    return render_analysis(analysis, request.fields, request.compact)
+
+# Send "X-Profile: 1" (stage timings) or "X-Profile: capture" (timings plus a
+# sampled stack profile saved under PROFILE_DIR) together with an admin "X-Admin-Key".
 @app.post("/generate", response_model=PromptAnalysis)
-def generate_prompt_api(request: PromptRequest):
+async def generate_prompt_api(request: PromptRequest, http_request: Request,
+                              x_profile: Optional[str] = Header(None),
+                              x_admin_key: Optional[str] = Header(None)):
+    return await run_until_disconnect(http_request, handle_generate, request, x_profile, x_admin_key)
+
+def handle_regenerate_section(request: RegenerateSectionRequest) -> Response:
+    start = time.perf_counter()
+    try:
+        analysis = regenerate_section(request.analysis, request.section, request.instructions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        print(f"Error regenerating section {request.section}: {e}")
+        raise HTTPException(status_code=502, detail=f"{type(e).__name__}: {e}")
+    metrics.increment(f"regenerate_section.{request.section}")
+    metrics.observe("regenerate_section.ms", (time.perf_counter() - start) * 1000)
+    return render_analysis(analysis)
+
+# Rewrites a single section the user didn't like; the other sections are kept as they are
+@app.post("/regenerate-section", response_model=PromptAnalysis)
+async def regenerate_section_api(request: RegenerateSectionRequest, http_request: Request):
+    return await run_until_disconnect(http_request, handle_regenerate_section, request)
+
+def run_job(payload: Dict) -> Dict:
+    """Job handler: one generation. Fallback analyses (upstream error, no key) count as failed attempts."""
+    analysis = generate_systematic_prompt(payload["prompt"], deterministic=payload.get("deterministic", False))
+    error = failure_reason(analysis)
+    if error is not None:
+        raise JobFailed(error)
+    return analysis.model_dump()
+
+JOB_QUEUE = open_job_queue(run_job)
+
+# Asynchronous generation: POST returns a job id at once; poll GET /jobs/{id} for the result
+@app.post("/jobs", status_code=202)
+def submit_job_api(request: JobRequest):
     if not request.prompt.strip():
         raise HTTPException(status_code=400, detail="Prompt cannot be empty")
-    
-    analysis = generate_systematic_prompt(request.prompt)
-    return analysis
+    if JOB_QUEUE is None:
+        raise HTTPException(status_code=503, detail="Job queue is disabled")
+    JOB_QUEUE.start()
+    job_id = JOB_QUEUE.submit({"prompt": request.prompt, "deterministic": request.deterministic},
+                              callback=request.callback)
+    return {"id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+def read_job_api(job_id: str):
+    job = JOB_QUEUE.get(job_id) if JOB_QUEUE is not None else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+# Refinement session: send {"prompt": ...} once, then {"edit": ...} for each tweak.
+# Each reply is {"type": "analysis", "analysis": {...}, "revised_sections": [...]}
+# or {"type": "error", "detail": ...}.
+@app.websocket("/ws/refine")
+async def refine_session(websocket: WebSocket):
+    await websocket.accept()
+    session = RefinementSession()
+    try:
+        while True:
+            message = await websocket.receive_json()
+            try:
+                if message.get("prompt", "").strip():
+                    analysis = await run_in_threadpool(
+                        session.start, message["prompt"], bool(message.get("deterministic", False))
+                    )
+                    result = {"analysis": analysis, "revised_sections": ["situation", "task", "objective", "knowledge", "suggestions"]}
+                elif message.get("edit", "").strip():
+                    result = await run_in_threadpool(session.revise, message["edit"])
+                else:
+                    raise ValueError("Send a non-empty 'prompt' or 'edit'")
+            except (ValueError, RuntimeError) as e:
+                await websocket.send_json({"type": "error", "detail": str(e)})
+                continue
+            except Exception as e:
+                print(f"Error in refinement session: {e}")
+                await websocket.send_json({"type": "error", "detail": f"{type(e).__name__}: {e}"})
+                continue
+
+            metrics.increment("refine.rounds")
+            await websocket.send_json({
+                "type": "analysis",
+                "analysis": result["analysis"].model_dump(),
+                "revised_sections": result["revised_sections"]
+            })
+    except WebSocketDisconnect:
+        pass
@@ -0,0 +1,59 @@
+from collections import deque
+from typing import List, Set
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over a fixed list of terms.
+
+    One pass over the text reports every term that occurs anywhere in it
+    (plain substring semantics, same as `term in text`), regardless of how
+    many terms there are.
+    """
+
+    def __init__(self, terms: List[str]):
+        self.terms = list(terms)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out: List[List[int]] = [[]]
+
+        for term_id, term in enumerate(self.terms):
+            state = 0
+            for char in term:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(term_id)
+
+        # Breadth-first pass to fill failure links and merge outputs along them
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, nxt in self._goto[state].items():
+                pending.append(nxt)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> Set[int]:
+        """Returns the ids (positions in `terms`) of every term found in text."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        # Empty terms match everything, as with `"" in text`
+        found.update(out[0])
+        return found
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+from app.cancellation import CancelToken, cancel_scope
+from app.embeddings import analyze_prompt_similarity
+from app.intent_classifier import IntentClassifier
+from app.metrics import metrics
+from app.result_cache import normalize_prompt
+from app.token_budget import prepare_prompt
+import app.prompt_engine as prompt_engine
+
+PREFETCH_TTL_SECONDS = float(os.getenv("PREFETCH_TTL_SECONDS", "120"))
+PREFETCH_MAX_ENTRIES = int(os.getenv("PREFETCH_MAX_ENTRIES", "1024"))
+# Budget for speculative completions: concurrent slots and starts per minute
+PREFETCH_SPECULATIVE_SLOTS = int(os.getenv("PREFETCH_SPECULATIVE_SLOTS", "2"))
+PREFETCH_SPECULATIVE_PER_MINUTE = int(os.getenv("PREFETCH_SPECULATIVE_PER_MINUTE", "30"))
+
+
+class PrefetchEntry:
+    def __init__(self, similarity: Dict, intent: Dict):
+        self.similarity = similarity
+        self.intent = intent
+        self.created_at = time.time()
+        self.completion: Optional[Future] = None
+        self.cancel_token = CancelToken()
+        self.deterministic = False
+
+
+class SpeculativePrefetcher:
+    """
+    Work done ahead of /generate while the user is still typing.
+
+    prefetch() caches the embedding similarity and IntentClassifier result for
+    a draft and, within budget, starts the completion speculatively. When a
+    session sends a newer draft, the speculative completion for its previous
+    draft is cancelled if it hasn't started, or stopped mid-stream (its
+    upstream calls are cancelled) if it has. take() hands /generate whatever
+    is ready.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, PrefetchEntry]" = OrderedDict()
+        self._sessions: Dict[str, str] = {}
+        self._slots = threading.BoundedSemaphore(PREFETCH_SPECULATIVE_SLOTS)
+        self._executor = ThreadPoolExecutor(max_workers=PREFETCH_SPECULATIVE_SLOTS,
+                                            thread_name_prefix="speculative")
+        self._window_start = time.time()
+        self._window_starts = 0
+        self._lookups = 0
+        self._hits = 0
+        self._classifier = None
+
+    def prefetch(self, prompt: str, session_id: Optional[str] = None,
+                 speculate: bool = False, deterministic: bool = False) -> Dict:
+        key = normalize_prompt(prompt)
+        metrics.increment("prefetch.requests")
+        if session_id:
+            self._supersede(session_id, key)
+
+        entry = self._get(key)
+        if entry is None:
+            if self._classifier is None:
+                self._classifier = IntentClassifier()
+            prepared = prepare_prompt(prompt)
+            entry = PrefetchEntry(
+                similarity=analyze_prompt_similarity(prepared['text'], top_k=1,
+                                                     prefilter=prompt_engine.INTENT_SOURCE == "llm"),
+                intent=self._classifier.classify_intent(prompt)
+            )
+            self._put(key, entry)
+
+        if speculate and entry.completion is None:
+            self._speculate(prompt, entry, deterministic)
+
+        return {
+            'similarity_score': entry.similarity['similarity_score'],
+            'is_vague': entry.similarity['is_vague'],
+            'intent': entry.intent,
+            'speculative': entry.completion is not None
+        }
+
+    def take(self, prompt: str, deterministic: bool = False) -> Optional[PrefetchEntry]:
+        """Removes and returns the entry for this prompt, if still fresh."""
+        with self._lock:
+            entry = self._entries.pop(normalize_prompt(prompt), None)
+        if entry is None or time.time() - entry.created_at > PREFETCH_TTL_SECONDS:
+            if entry is not None:
+                self._cancel(entry)
+            self._record_lookup("prefetch.misses")
+            return None
+        if entry.completion is not None and entry.deterministic != deterministic:
+            # Nobody will read this speculative run: stop it rather than let it spend tokens and a slot
+            self._cancel(entry)
+        self._record_lookup("prefetch.hits_full" if entry.completion is not None else "prefetch.hits_partial")
+        return entry
+
+    def _record_lookup(self, outcome: str):
+        metrics.increment(outcome)
+        with self._lock:
+            self._lookups += 1
+            self._hits += outcome != "prefetch.misses"
+            hit_rate = self._hits / float(self._lookups)
+        metrics.set_gauge("prefetch.hit_rate", hit_rate)
+
+    def _get(self, key: str) -> Optional[PrefetchEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry.created_at > PREFETCH_TTL_SECONDS:
+                del self._entries[key]
+                self._cancel(entry)
+                return None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key: str, entry: PrefetchEntry):
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > PREFETCH_MAX_ENTRIES:
+                _, evicted = self._entries.popitem(last=False)
+                self._cancel(evicted)
+
+    def _supersede(self, session_id: str, key: str):
+        with self._lock:
+            previous = self._sessions.get(session_id)
+            self._sessions[session_id] = key
+            if len(self._sessions) > PREFETCH_MAX_ENTRIES:
+                self._sessions.pop(next(iter(self._sessions)))
+            if previous and previous != key:
+                entry = self._entries.get(previous)
+                if entry is not None:
+                    self._cancel(entry)
+
+    def _cancel(self, entry: PrefetchEntry):
+        if entry.completion is not None and not entry.completion.done():
+            if entry.completion.cancel():
+                metrics.increment("prefetch.speculative_cancelled")
+            else:
+                metrics.increment("prefetch.speculative_abandoned")
+            entry.cancel_token.cancel()
+        entry.completion = None
+        # The entry (and its similarity) stays usable; a later run needs a live token
+        entry.cancel_token = CancelToken()
+
+    def _within_rate(self) -> bool:
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= 60:
+                self._window_start, self._window_starts = now, 0
+            if self._window_starts >= PREFETCH_SPECULATIVE_PER_MINUTE:
+                return False
+            self._window_starts += 1
+            return True
+
+    def _speculate(self, prompt: str, entry: PrefetchEntry, deterministic: bool):
+        if not self._slots.acquire(blocking=False):
+            metrics.increment("prefetch.speculative_skipped_budget")
+            return
+        if not self._within_rate():
+            self._slots.release()
+            metrics.increment("prefetch.speculative_skipped_budget")
+            return
+
+        # Bound now: _cancel replaces entry.cancel_token, possibly before run() starts
+        token = entry.cancel_token
+
+        def run():
+            try:
+                with cancel_scope(token):
+                    return prompt_engine.generate_systematic_prompt(
+                        prompt, deterministic=deterministic, precomputed_similarity=entry.similarity
+                    )
+            finally:
+                self._slots.release()
+
+        entry.deterministic = deterministic
+        entry.completion = self._executor.submit(run)
+        # A cancelled-before-start task never runs `run`, so free its slot here
+        entry.completion.add_done_callback(lambda f: self._slots.release() if f.cancelled() else None)
+        metrics.increment("prefetch.speculative_started")
+
+
+PREFETCHER = SpeculativePrefetcher()
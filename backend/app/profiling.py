@@ -0,0 +1,146 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+# Comma-separated keys allowed to request per-request profiles
+ADMIN_API_KEYS = {key.strip() for key in os.getenv("ADMIN_API_KEYS", "").split(",") if key.strip()}
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "2"))
+
+
+def is_admin_key(key: Optional[str]) -> bool:
+    return bool(key) and key in ADMIN_API_KEYS
+
+
+class RequestProfile:
+    """Stage timings (and optional sampled stacks) for one request."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:12]
+        self.started = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self.capture_path: Optional[str] = None
+
+    def record(self, name: str, ms: float):
+        self.stages.append((name, ms))
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        """Formats the stages as a Server-Timing header value."""
+        entries = [f"{name};dur={ms:.2f}" for name, ms in self.stages]
+        entries.append(f"total;dur={self.total_ms():.2f}")
+        return ", ".join(entries)
+
+
+_current_profile: ContextVar[Optional[RequestProfile]] = ContextVar("current_profile", default=None)
+
+
+def current_profile() -> Optional[RequestProfile]:
+    return _current_profile.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Times a pipeline stage when the current request is being profiled; otherwise a no-op."""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.record(name, (time.perf_counter() - start) * 1000)
+
+
+class StageClock:
+    """
+    Times consecutive stages without wrapping them in a block: each lap()
+    closes the stage that began at the previous lap (or at construction).
+    """
+
+    def __init__(self):
+        self.profile = _current_profile.get()
+        self.last = time.perf_counter()
+
+    def lap(self, name: str):
+        now = time.perf_counter()
+        if self.profile is not None:
+            self.profile.record(name, (now - self.last) * 1000)
+        self.last = now
+
+
+class SamplingProfiler:
+    """
+    Samples one thread's stack every `interval_ms` from a background thread
+    and writes the result in collapsed-stack format (one "frame;frame;... count"
+    line per unique stack), which flamegraph.pl and speedscope can load.
+    """
+
+    def __init__(self, thread_id: int, interval_ms: float = PROFILE_SAMPLE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000.0
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profile_request(capture: bool = False):
+    """
+    Enables stage timing for the work done inside the block (on this thread
+    and anything that inherits its context). With capture=True the calling
+    thread is also sampled and the stacks are saved under PROFILE_DIR.
+    """
+    profile = RequestProfile()
+    token = _current_profile.set(profile)
+    sampler = None
+    if capture:
+        sampler = SamplingProfiler(threading.get_ident())
+        sampler.start()
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+        if sampler is not None:
+            sampler.stop()
+            profile.capture_path = os.path.join(PROFILE_DIR, f"{profile.id}.folded")
+            try:
+                sampler.write(profile.capture_path)
+            except OSError as e:
+                print(f"Error saving profile {profile.id}: {e}")
+                profile.capture_path = None
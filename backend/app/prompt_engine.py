@@ -1,22 +1,52 @@
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 import re
 
 # Load environment variables from .env file
 load_dotenv()
 
-from app.embeddings import analyze_similarity
+from app.embeddings import analyze_prompt_similarity
+from app.result_cache import RESULT_CACHE, cache_key
+from app.profiling import StageClock, stage
+from app.token_budget import prepare_prompt
+from app.metrics import metrics
+from app.cancellation import RequestCancelled
+from app.upstream import chat_completion, create_client
+from app.ledger import ledger_entry, note
 
 # Configure OpenAI API
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-if OPENAI_API_KEY:
-    client = OpenAI(api_key=OPENAI_API_KEY)
-else:
-    client = None
+client = create_client(OPENAI_API_KEY)
+
+COMPLETION_MODEL = os.getenv("COMPLETION_MODEL", "gpt-4o-mini")
+COMPLETION_TEMPERATURE = float(os.getenv("COMPLETION_TEMPERATURE", "0.7"))
+COMPLETION_MAX_TOKENS = int(os.getenv("COMPLETION_MAX_TOKENS", "1500"))
+
+# Bump whenever the instruction template or parsing changes so cached results are not reused
+INSTRUCTION_VERSION = "2"
+
+# Where PromptAnalysis.intent comes from:
+#   "llm"       - the [INTENT] section of the completion (default)
+#   "embedding" - the nearest curated intent centroid; [INTENT] is dropped from the instruction
+#   "auto"      - the centroid when its score is at least INTENT_CENTROID_MIN_SCORE, else the LLM
+INTENT_SOURCE = os.getenv("INTENT_SOURCE", "llm")
+INTENT_CENTROID_MIN_SCORE = float(os.getenv("INTENT_CENTROID_MIN_SCORE", "0.5"))
+
+LLM_INTENT_STEPS = """1. Identify the Intent (Coding, Image, Writing, Marketing, or General).
+        2. Create the STOK framework.
+        3. Generate 3 specific, actionable suggestions."""
+LLM_INTENT_BLOCK = """[INTENT]
+        (The intent here)
+        
+        """
+KNOWN_INTENT_STEPS = """1. Create the STOK framework.
+        2. Generate 3 specific, actionable suggestions."""
+
+# Sampled (temperature > 0) results are only cached when explicitly allowed
+RESULT_CACHE_SAMPLED = os.getenv("RESULT_CACHE_SAMPLED", "false").lower() == "true"
 
 class StructuredPrompt(BaseModel):
     situation: str
@@ -30,10 +60,21 @@ class PromptAnalysis(BaseModel):
     structured_prompt: StructuredPrompt
     intent: str
     confidence_score: int
-    similarity_score: float
+    # None when the local pre-filter settled is_vague without measuring a similarity
+    similarity_score: Optional[float] = None
     is_vague: bool
     suggestions: List[str]
 
+NO_KEY_SITUATION = "API Key Missing"
+
+def failure_reason(analysis: PromptAnalysis) -> Optional[str]:
+    """Why `analysis` is a fallback (upstream error, no API key) rather than a generation; None if it isn't."""
+    if analysis.intent == "error":
+        return analysis.structured_prompt.task
+    if analysis.structured_prompt.situation == NO_KEY_SITUATION:
+        return "OPENAI_API_KEY not set"
+    return None
+
 def identify_intent_fallback(text: str) -> str:
     """Simple intent detection for fallback."""
     text = text.lower()
@@ -43,16 +84,42 @@ def identify_intent_fallback(text: str) -> str:
     if any(k in text for k in ["market", "brand", "audience", "ad"]): return "marketing"
     return "general"
 
-def generate_systematic_prompt(prompt: str) -> PromptAnalysis:
-    """Uses OpenAI API to generate a high-quality STOK prompt."""
-    
+def format_enhanced_prompt(stok: StructuredPrompt) -> str:
+    """Renders the STOK sections as the markdown shown in enhanced_prompt."""
+    return f"""**Situation**
+{stok.situation}
+
+**Task**
+{stok.task}
+
+**Objective**
+{stok.objective}
+
+**Knowledge**
+{stok.knowledge}"""
+
+def generate_systematic_prompt(prompt: str, deterministic: bool = False,
+                               precomputed_similarity: Optional[Dict] = None) -> PromptAnalysis:
+    """
+    Uses OpenAI API to generate a high-quality STOK prompt.
+    deterministic=True runs at temperature 0, which makes the result cache-eligible.
+    precomputed_similarity (from analyze_prompt_similarity on the prepared text,
+    e.g. done by /prefetch) skips the embedding call.
+    Each call appends a row (intent, tokens, stage latencies) to the ledger.
+    """
+    with ledger_entry():
+        return _generate_systematic_prompt(prompt, deterministic, precomputed_similarity)
+
+def _generate_systematic_prompt(prompt: str, deterministic: bool,
+                                precomputed_similarity: Optional[Dict]) -> PromptAnalysis:
     if not client:
+        note(outcome="no_key")
         # Fallback if no API key (prevents crashing)
         return PromptAnalysis(
             original_prompt=prompt,
             enhanced_prompt="Error: OPENAI_API_KEY not set. Please add it to your environment variables.",
             structured_prompt=StructuredPrompt(
-                situation="API Key Missing",
+                situation=NO_KEY_SITUATION,
                 task="Please configure backend environment variables.",
                 objective="Enable AI Features",
                 knowledge="Get key from platform.openai.com"
@@ -64,9 +131,53 @@ def generate_systematic_prompt(prompt: str) -> PromptAnalysis:
             suggestions=["Add OPENAI_API_KEY to backend .env", "Deploy with env var"]
         )
 
+    temperature = 0.0 if deterministic else COMPLETION_TEMPERATURE
+    key = None
+    note(cache="off")
+    if RESULT_CACHE and (temperature == 0.0 or RESULT_CACHE_SAMPLED):
+        key = cache_key(prompt, COMPLETION_MODEL, temperature, f"{INSTRUCTION_VERSION}:{INTENT_SOURCE}")
+        with stage("cache_lookup"):
+            cached = RESULT_CACHE.get(key)
+        if cached is not None:
+            analysis = PromptAnalysis.model_validate_json(cached)
+            # The entry may have been stored for a prompt that differs in spacing
+            analysis.original_prompt = prompt
+            note(cache="hit", intent=analysis.intent.strip().lower(), similarity=analysis.similarity_score,
+                 is_vague=analysis.is_vague)
+            return analysis
+        note(cache="miss")
+
     try:
+        # Bound the input: summarize pasted tables locally, cap the token count
+        with stage("prepare"):
+            prepared = prepare_prompt(prompt)
+        metrics.observe("prompt.tokens", prepared['original_tokens'])
+        if prepared['data_blocks']:
+            metrics.increment("prompt.data_blocks_summarized", prepared['data_blocks'])
+        if prepared['truncated']:
+            metrics.increment("prompt.truncated")
+        user_text = prepared['text']
+
         # Hybrid Analysis: Calculate Similarity first
-        similarity_score, is_vague = analyze_similarity(prompt)
+        # (the local pre-filter can skip the embedding unless the intent is taken from it)
+        similarity = precomputed_similarity or analyze_prompt_similarity(
+            user_text, top_k=1, prefilter=INTENT_SOURCE == "llm"
+        )
+        similarity_score, is_vague = similarity['similarity_score'], similarity['is_vague']
+        # Pre-filtered prompts have no measured score; similarity_source says why
+        note(similarity=similarity_score, is_vague=is_vague,
+             similarity_source="precomputed" if precomputed_similarity else similarity.get('source'))
+        clock = StageClock()
+
+        # Decide the intent from the embedding before the completion when configured
+        embedding_intent = None
+        centroid = similarity['intent']
+        if centroid and (INTENT_SOURCE == "embedding" or
+                         (INTENT_SOURCE == "auto" and centroid['score'] >= INTENT_CENTROID_MIN_SCORE)):
+            embedding_intent = centroid['primary_intent']
+            metrics.increment("intent.from_embedding")
+        intent_steps = KNOWN_INTENT_STEPS if embedding_intent else LLM_INTENT_STEPS
+        intent_block = "" if embedding_intent else LLM_INTENT_BLOCK
         
         # Context note for the LLM
         vague_context = ""
@@ -75,7 +186,7 @@ def generate_systematic_prompt(prompt: str) -> PromptAnalysis:
 
         # Construct the prompt for OpenAI
         system_instruction = f"""
-        You are an expert prompt engineer. The user wants: "{prompt}"
+        You are an expert prompt engineer. The user wants: "{user_text}"
         {vague_context}
         
         Create an action-oriented STOK (Situation, Task, Objective, Knowledge) framework that helps them accomplish this goal.
@@ -88,16 +199,11 @@ def generate_systematic_prompt(prompt: str) -> PromptAnalysis:
         - Use proper markdown formatting with dashes (-) for bullet points
         - Make content specific to their request, not generic
         
-        1. Identify the Intent (Coding, Image, Writing, Marketing, or General).
-        2. Create the STOK framework.
-        3. Generate 3 specific, actionable suggestions.
+        {intent_steps}
         
         Output strictly in this format (no markdown code blocks, just the text sections separated by special markers):
         
-        [INTENT]
-        (The intent here)
-        
-        [SITUATION]
+        {intent_block}[SITUATION]
         (Define the ACTUAL working scenario - e.g., "You are writing a blog post for an audience interested in AI technology...")
         
         [TASK]
@@ -114,16 +220,19 @@ def generate_systematic_prompt(prompt: str) -> PromptAnalysis:
         - (Suggestion 2)
         - (Suggestion 3)
         """
+        clock.lap("prompt_build")
         
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
+        text_resp = chat_completion(
+            client,
+            model=COMPLETION_MODEL,
             messages=[
                 {"role": "system", "content": "You are an expert prompt engineer."},
                 {"role": "user", "content": system_instruction}
             ],
-            temperature=0.7
+            temperature=temperature,
+            max_tokens=COMPLETION_MAX_TOKENS
         )
-        text_resp = response.choices[0].message.content
+        clock.lap("upstream")
         
         # Parse logic
         intent_match = re.search(r'\[INTENT\]\s*(.*?)\s*(?=\[SITUATION\])', text_resp, re.DOTALL)
@@ -133,7 +242,10 @@ def generate_systematic_prompt(prompt: str) -> PromptAnalysis:
         knowledge_match = re.search(r'\[KNOWLEDGE\]\s*(.*?)\s*(?=\[SUGGESTIONS\])', text_resp, re.DOTALL)
         suggestions_match = re.search(r'\[SUGGESTIONS\]\s*(.*)', text_resp, re.DOTALL)
         
-        intent = intent_match.group(1).strip() if intent_match else "general"
+        intent = embedding_intent or (intent_match.group(1).strip() if intent_match else "general")
+        # The centroid's sub-intent only describes the row when the centroid also chose the intent
+        note(intent=intent.lower(), intent_source="embedding" if embedding_intent else "llm",
+             sub_intent=centroid['sub_intent'] if embedding_intent else None)
         situation = situation_match.group(1).strip() if situation_match else "Could not generate situation."
         task = task_match.group(1).strip() if task_match else "Could not generate task."
         objective = objective_match.group(1).strip() if objective_match else "Could not generate objective."
@@ -142,6 +254,7 @@ def generate_systematic_prompt(prompt: str) -> PromptAnalysis:
         
         # Split suggestions by newlines and clean up
         suggestions = [s.strip('- ').strip() for s in suggestions_raw.split('\n') if s.strip()]
+        clock.lap("parse")
         
         stok = StructuredPrompt(
             situation=situation,
@@ -150,30 +263,26 @@ def generate_systematic_prompt(prompt: str) -> PromptAnalysis:
             knowledge=knowledge
         )
         
-        full_text = f"""**Situation**
-{situation}
-
-**Task**
-{task}
-
-**Objective**
-{objective}
-
-**Knowledge**
-{knowledge}"""
-
-        return PromptAnalysis(
+        analysis = PromptAnalysis(
             original_prompt=prompt,
-            enhanced_prompt=full_text,
+            enhanced_prompt=format_enhanced_prompt(stok),
             structured_prompt=stok,
             intent=intent,
             confidence_score=98,
-            similarity_score=float(similarity_score),
+            similarity_score=float(similarity_score) if similarity_score is not None else None,
             is_vague=is_vague,
             suggestions=suggestions[:3]
         )
+        clock.lap("model")
+        if key is not None:
+            RESULT_CACHE.put(key, analysis.model_dump_json().encode("utf-8"))
+            clock.lap("cache_store")
+        return analysis
 
+    except RequestCancelled:
+        raise
     except Exception as e:
+        note(outcome="error")
         # Error handling with detailed logging
         error_msg = f"Error generating prompt: {str(e)}"
         print(f"\n❌ GEMINI API ERROR: {error_msg}")
@@ -0,0 +1,185 @@
+import os
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+
+
+# Storage settings for curated/cached embeddings.
+# EMBEDDING_DIMENSIONS is sent to the embeddings API as `dimensions` (unset = model default, 1536).
+# EMBEDDING_STORAGE is one of: float32, float16, int8 (int8 keeps a float32 scale per vector).
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0")) or None
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "float32")
+
+STORAGE_TYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "int8": np.int8
+}
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalizes each row so that a dot product equals cosine similarity."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        norm = np.linalg.norm(vectors)
+        return vectors / norm if norm else vectors
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def truncate_dimensions(vectors, dimensions: Optional[int]) -> np.ndarray:
+    """
+    Shortens embeddings to `dimensions` and re-normalizes them. For the
+    text-embedding-3 models this matches what the API's `dimensions`
+    parameter returns, so stored full-size vectors can be downsized locally.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not dimensions or vectors.shape[-1] <= dimensions:
+        return vectors
+    return normalize_rows(vectors[..., :dimensions])
+
+
+class CompactVectors:
+    """
+    Row-major embedding matrix kept in its compact dtype. Scores are computed
+    slice by slice against a float32 query, so the full matrix is never
+    expanded back to float32 in memory.
+    """
+
+    def __init__(self, codes: np.ndarray, scales: Optional[np.ndarray] = None):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def storage(self) -> str:
+        return self.codes.dtype.name
+
+    @property
+    def dimensions(self) -> int:
+        return self.codes.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def encode(cls, vectors, storage: str = "float32") -> "CompactVectors":
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown embedding storage '{storage}'. Use one of: {', '.join(STORAGE_TYPES)}")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if storage == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            codes = np.round(vectors / scales[:, None]).astype(np.int8)
+            return cls(codes, scales.astype(np.float32))
+        return cls(vectors.astype(STORAGE_TYPES[storage]))
+
+    def dot(self, query: np.ndarray, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+        """Scores rows [start:end] against a float32 query vector."""
+        scores = self.codes[start:end] @ query.astype(np.float32)
+        if self.scales is not None:
+            scores = scores * self.scales[start:end]
+        return scores.astype(np.float32, copy=False)
+
+    def take(self, order: np.ndarray) -> "CompactVectors":
+        return CompactVectors(self.codes[order], self.scales[order] if self.scales is not None else None)
+
+    def decode(self, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+        """Rows [start:end] as float32 (decode large matrices slice by slice)."""
+        vectors = self.codes[start:end].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[start:end, None]
+        return vectors
+
+    def iter_slices(self, rows: int = 8192):
+        """Yields (start, float32 rows) over the matrix, `rows` at a time."""
+        for start in range(0, len(self.codes), rows):
+            yield start, self.decode(start, start + rows)
+
+
+def compare_storage(corpus, queries, configs: Sequence[Dict], k: int = 5,
+                    threshold: float = 0.35, exclude_self: bool = False) -> List[Dict]:
+    """
+    Measures how each storage config changes similarity decisions relative to
+    full-precision float32 vectors.
+
+    configs: [{'dimensions': int or None, 'storage': str}, ...]
+    Returns one row per config with is_vague agreement, mean top-k overlap,
+    max score error and bytes per vector. exclude_self=True means queries[i]
+    is corpus[i] (leave-one-out).
+    """
+    corpus = normalize_rows(corpus)
+    queries = normalize_rows(queries)
+
+    def rank(scores):
+        if exclude_self:
+            # Query i is corpus row i: drop the self-match by position. A score cutoff
+            # misses it under lossy storage (int8 self-similarity is ~0.9995)
+            scores = scores.copy()
+            np.fill_diagonal(scores, -np.inf)
+        top = np.argsort(-scores, axis=1)[:, :k]
+        return top, np.take_along_axis(scores, top[:, :1], axis=1)[:, 0]
+
+    full_top, full_best = rank(queries @ corpus.T)
+    full_vague = full_best < threshold
+
+    rows = []
+    for config in configs:
+        dims = config.get('dimensions')
+        compact = CompactVectors.encode(truncate_dimensions(corpus, dims), config.get('storage', 'float32'))
+        short_queries = truncate_dimensions(queries, dims)
+        scores = np.stack([compact.dot(q) for q in short_queries])
+        top, best = rank(scores)
+
+        overlap = [len(np.intersect1d(a, b)) / float(len(a)) for a, b in zip(full_top, top)]
+        rows.append({
+            'dimensions': compact.dimensions,
+            'storage': compact.storage,
+            'bytes_per_vector': compact.nbytes / float(len(compact)),
+            'vague_agreement': float(np.mean((best < threshold) == full_vague)),
+            'topk_overlap': float(np.mean(overlap)),
+            'max_score_error': float(np.max(np.abs(best - full_best)))
+        })
+    return rows
+
+
+# Measurement tool: compare storage formats on real curated embeddings
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare compact embedding formats against full precision")
+    parser.add_argument("--index", help="Saved curated index (.npz) to use as corpus and leave-one-out queries")
+    parser.add_argument("--queries", nargs="*", default=[
+        "do it", "help", "make it better", "write something",
+        "Write a Python script to scrape data", "create a logo for my bakery",
+        "draft a launch email for our new analytics dashboard",
+        "fix the migration error in my Django project"
+    ], help="Extra query prompts to embed (needs OPENAI_API_KEY when not using --index)")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    from app.embeddings import VAGUE_THRESHOLD, iter_curated_prompts, get_embedding
+    from app.ann_index import IVFIndex
+
+    if args.index:
+        corpus = IVFIndex.load(args.index).original_vectors()
+        queries, exclude_self = corpus, True
+    else:
+        # Embed at full size so every reduced config is derived from the same vectors
+        corpus = np.array([get_embedding(p, dimensions=None) for _, p in iter_curated_prompts()], dtype=np.float32)
+        queries = np.array([get_embedding(q, dimensions=None) for q in args.queries], dtype=np.float32)
+        exclude_self = False
+
+    configs = [{'dimensions': d, 'storage': s}
+               for d in (None, 1024, 512, 256)
+               for s in ("float32", "float16", "int8")]
+    results = compare_storage(corpus, queries, configs, k=args.k,
+                              threshold=VAGUE_THRESHOLD, exclude_self=exclude_self)
+
+    print(f"{'dims':>5} {'storage':>8} {'bytes/vec':>10} {'is_vague agree':>15} {'top-k overlap':>14} {'max Δscore':>11}")
+    for row in results:
+        print(f"{row['dimensions']:>5} {row['storage']:>8} {row['bytes_per_vector']:>10.0f} "
+              f"{row['vague_agreement']:>15.3f} {row['topk_overlap']:>14.3f} {row['max_score_error']:>11.4f}")
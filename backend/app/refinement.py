@@ -0,0 +1,185 @@
+import os
+import re
+from typing import Dict, List, Optional
+
+from app.prompt_engine import (
+    COMPLETION_MODEL, COMPLETION_TEMPERATURE, PromptAnalysis, StructuredPrompt, format_enhanced_prompt
+)
+import app.prompt_engine as prompt_engine
+from app.ledger import ledger_entry, note
+from app.upstream import chat_completion
+
+# Output budget for a revision round (only changed sections come back)
+REFINE_MAX_TOKENS = int(os.getenv("REFINE_MAX_TOKENS", "600"))
+# After this many edits the conversation is re-seeded from the current sections
+REFINE_MAX_TURNS = int(os.getenv("REFINE_MAX_TURNS", "6"))
+# Output budget for regenerating one section (a full generation allows COMPLETION_MAX_TOKENS)
+SECTION_MAX_TOKENS = int(os.getenv("SECTION_MAX_TOKENS", "450"))
+
+STOK_SECTIONS = ["situation", "task", "objective", "knowledge"]
+SECTION_MARKER = re.compile(r'\[(SITUATION|TASK|OBJECTIVE|KNOWLEDGE|SUGGESTIONS)\]')
+
+REVISE_SYSTEM_PROMPT = "You are an expert prompt engineer revising an existing STOK (Situation, Task, Objective, Knowledge) prompt."
+
+
+def split_sections(text: str) -> Dict[str, str]:
+    """Splits "[SECTION] body" blocks in any order; sections that are absent are left out."""
+    sections = {}
+    parts = SECTION_MARKER.split(text)
+    for name, body in zip(parts[1::2], parts[2::2]):
+        sections[name.lower()] = body.strip()
+    return sections
+
+
+def render_sections(stok: StructuredPrompt, exclude: Optional[str] = None) -> str:
+    return "\n\n".join(f"[{name.upper()}]\n{getattr(stok, name)}" for name in STOK_SECTIONS if name != exclude)
+
+
+def parse_suggestions(text: str) -> List[str]:
+    return [s.strip('- ').strip() for s in text.split('\n') if s.strip()][:3]
+
+
+class RefinementSession:
+    """
+    Server-side state for one refinement conversation.
+
+    The first round is a normal generation. Later rounds send the model only
+    the requested change plus a compact conversation (current sections and
+    previous edits, not the long generation instruction), and the model
+    returns only the sections it changed, which are merged into the last
+    PromptAnalysis.
+    """
+
+    def __init__(self):
+        self.analysis: Optional[PromptAnalysis] = None
+        self.messages: List[Dict[str, str]] = []
+        self.turns = 0
+
+    def start(self, prompt: str, deterministic: bool = False) -> PromptAnalysis:
+        self.analysis = prompt_engine.generate_systematic_prompt(prompt, deterministic=deterministic)
+        self.messages = []
+        self.turns = 0
+        return self.analysis
+
+    def _seed(self):
+        self.messages = [
+            {"role": "system", "content": REVISE_SYSTEM_PROMPT},
+            {"role": "user", "content": f"""The user originally asked for: "{self.analysis.original_prompt}"
+
+This is the current STOK prompt:
+
+{render_sections(self.analysis.structured_prompt)}
+
+I will send change requests one at a time. For each one, reply with ONLY the sections that must change, using the same [SECTION] markers and markdown dash bullets. Leave unchanged sections out entirely. If the change affects what the user should do next, also include a [SUGGESTIONS] section with 3 dash bullets."""},
+            {"role": "assistant", "content": "Understood. Send the first change."}
+        ]
+        self.turns = 0
+
+    def revise(self, edit: str) -> Dict:
+        """Applies one change request. Returns {'analysis', 'revised_sections'}."""
+        if self.analysis is None:
+            raise ValueError("Send a prompt before sending edits")
+        if not prompt_engine.client:
+            raise RuntimeError("OPENAI_API_KEY not set")
+
+        with ledger_entry(kind="refine"):
+            note(intent=self.analysis.intent.strip().lower())
+            return self._revise(edit)
+
+    def _revise(self, edit: str) -> Dict:
+        if not self.messages or self.turns >= REFINE_MAX_TURNS:
+            self._seed()
+        request = {"role": "user", "content": f"Change request: {edit}"}
+
+        reply = chat_completion(
+            prompt_engine.client,
+            model=COMPLETION_MODEL,
+            messages=self.messages + [request],
+            temperature=COMPLETION_TEMPERATURE,
+            max_tokens=REFINE_MAX_TOKENS
+        )
+        # Only a change that got a reply joins the conversation: the client was told a
+        # failed (or cancelled) edit didn't happen, so later rounds must not apply it
+        self.messages.extend([request, {"role": "assistant", "content": reply}])
+        self.turns += 1
+
+        sections = split_sections(reply)
+        stok = self.analysis.structured_prompt.model_copy(
+            update={name: sections[name] for name in STOK_SECTIONS if sections.get(name)}
+        )
+        suggestions = self.analysis.suggestions
+        if sections.get("suggestions"):
+            suggestions = parse_suggestions(sections["suggestions"])
+
+        self.analysis = self.analysis.model_copy(update={
+            "structured_prompt": stok,
+            "enhanced_prompt": format_enhanced_prompt(stok),
+            "suggestions": suggestions
+        })
+        return {
+            'analysis': self.analysis,
+            'revised_sections': [name for name in STOK_SECTIONS + ["suggestions"] if sections.get(name)]
+        }
+
+
+def regenerate_section(analysis: PromptAnalysis, section: str, instructions: Optional[str] = None) -> PromptAnalysis:
+    """
+    Rewrites one section ("situation", "task", "objective", "knowledge" or
+    "suggestions") of an existing analysis. The other sections go along as
+    context and only the requested one comes back, under SECTION_MAX_TOKENS.
+    """
+    if section not in STOK_SECTIONS + ["suggestions"]:
+        raise ValueError(f"Unknown section: {section}")
+    if not prompt_engine.client:
+        raise RuntimeError("OPENAI_API_KEY not set")
+
+    with ledger_entry(kind="regenerate_section"):
+        note(intent=analysis.intent.strip().lower())
+        return _regenerate_section(analysis, section, instructions)
+
+
+def _regenerate_section(analysis: PromptAnalysis, section: str, instructions: Optional[str]) -> PromptAnalysis:
+    stok = analysis.structured_prompt
+    if section == "suggestions":
+        current = "\n".join(f"- {s}" for s in analysis.suggestions)
+        context = render_sections(stok)
+        shape = "3 specific, actionable dash bullets"
+    else:
+        current = getattr(stok, section)
+        context = render_sections(stok, exclude=section)
+        shape = "proper markdown formatting with dashes (-) for bullet points"
+    marker = f"[{section.upper()}]"
+    request = f" The user asked for this change: \"{instructions}\"." if instructions else ""
+
+    reply = chat_completion(
+        prompt_engine.client,
+        model=COMPLETION_MODEL,
+        messages=[
+            {"role": "system", "content": REVISE_SYSTEM_PROMPT},
+            {"role": "user", "content": f"""The user originally asked for: "{analysis.original_prompt}"
+
+The other sections of their STOK prompt, for context:
+
+{context}
+
+The user was not happy with this {marker} section:
+
+{current}
+
+Write a better {marker} section that fits the rest of the prompt and is specific to their request.{request} Use {shape}. Reply with ONLY the {marker} marker followed by the new section."""}
+        ],
+        temperature=COMPLETION_TEMPERATURE,
+        max_tokens=SECTION_MAX_TOKENS
+    )
+    # Accept a bare reply too, in case the model drops the marker
+    body = split_sections(reply).get(section) or SECTION_MARKER.sub("", reply).strip()
+    if not body:
+        raise RuntimeError(f"The model returned an empty {section} section")
+
+    if section == "suggestions":
+        return analysis.model_copy(update={"suggestions": parse_suggestions(body)})
+    stok = stok.model_copy(update={section: body})
+    return analysis.model_copy(update={
+        "structured_prompt": stok,
+        "enhanced_prompt": format_enhanced_prompt(stok)
+    })
@@ -264,10 +264,10 @@ Please provide more details about:
 if __name__ == "__main__":
     import sys
     from pathlib import Path
-    # Add parent directory to path for imports
-    sys.path.insert(0, str(Path(__file__).parent))
+    # Add backend directory to path for app.* imports
+    sys.path.insert(0, str(Path(__file__).parent.parent))
     
-    from intent_classifier import IntentClassifier
+    from app.intent_classifier import IntentClassifier
     
     classifier = IntentClassifier()
     template_gen = ReportTemplateGenerator()
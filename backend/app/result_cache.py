@@ -0,0 +1,120 @@
+import hashlib
+import os
+import re
+import time
+from typing import Optional
+
+from app.metrics import metrics
+from app.sqlite_store import WALDatabase, open_optional
+
+# Disk-backed result store shared by every worker on the host. Set RESULT_CACHE_PATH="" to disable.
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "data/result_cache.sqlite3")
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Eviction runs after this many writes (per process) rather than on every put
+EVICT_EVERY_WRITES = 200
+EVICT_CHUNK_ROWS = 1000
+
+INDENT_PATTERN = re.compile(r"[ \t]*")
+SPACE_RUN_PATTERN = re.compile(r" +")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Collapses runs of spaces so trivially different inputs share a cache
+    entry. Line breaks, indentation and tabs are kept: prepare_prompt reads
+    line structure and tab delimiters (pasted tables), and indentation can
+    matter in code.
+    """
+    lines = []
+    for line in prompt.strip(" \r\n").splitlines():
+        indent = INDENT_PATTERN.match(line).group()
+        lines.append(indent + SPACE_RUN_PATTERN.sub(" ", line[len(indent):]).rstrip(" "))
+    return "\n".join(lines)
+
+
+def cache_key(prompt: str, model: str, temperature: float, instruction_version: str) -> bytes:
+    """Hash of everything that determines the upstream output."""
+    material = "\x1f".join([normalize_prompt(prompt), model, f"{temperature:.3f}", instruction_version])
+    return hashlib.sha256(material.encode("utf-8")).digest()
+
+
+class ResultCache:
+    """
+    Exact-match store of serialized results in SQLite (WAL mode).
+
+    Each thread gets its own connection; WAL lets readers in other workers and
+    processes proceed while one writes. Lookups are a single primary-key probe
+    on a WITHOUT ROWID table, so they stay flat as the table grows. Entries
+    expire after `ttl_seconds`; the oldest entries are evicted once the stored
+    payload exceeds `max_bytes`.
+    """
+
+    def __init__(self, path: str, ttl_seconds: int = RESULT_CACHE_TTL_SECONDS,
+                 max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._writes = 0
+        self._db = WALDatabase(path, (
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key BLOB PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL"
+            ") WITHOUT ROWID",
+            "CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)"
+        ))
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        start = time.perf_counter()
+        row = self._db.connect().execute(
+            "SELECT value FROM results WHERE key = ? AND created_at >= ?",
+            (key, time.time() - self.ttl_seconds)
+        ).fetchone()
+        metrics.observe("result_cache.lookup_ms", (time.perf_counter() - start) * 1000)
+
+        if row is None:
+            metrics.increment("result_cache.misses")
+            return None
+        metrics.increment("result_cache.hits")
+        metrics.increment("result_cache.bytes_read", len(row[0]))
+        return row[0]
+
+    def put(self, key: bytes, value: bytes):
+        self._db.connect().execute(
+            "INSERT OR REPLACE INTO results (key, value, size, created_at) VALUES (?, ?, ?, ?)",
+            (key, value, len(value), time.time())
+        )
+        metrics.increment("result_cache.writes")
+        metrics.increment("result_cache.bytes_written", len(value))
+
+        self._writes += 1
+        if self._writes % EVICT_EVERY_WRITES == 0:
+            self.evict()
+
+    def evict(self):
+        """Drops expired entries, then the oldest entries until under max_bytes."""
+        conn = self._db.connect()
+        expired = conn.execute("DELETE FROM results WHERE created_at < ?",
+                               (time.time() - self.ttl_seconds,)).rowcount
+        evicted = 0
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        while total > self.max_bytes:
+            freed, rows = conn.execute(
+                "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM ("
+                " SELECT size FROM results ORDER BY created_at LIMIT ?)", (EVICT_CHUNK_ROWS,)
+            ).fetchone()
+            if not rows:
+                break
+            conn.execute(
+                "DELETE FROM results WHERE key IN ("
+                " SELECT key FROM results ORDER BY created_at LIMIT ?)", (EVICT_CHUNK_ROWS,)
+            )
+            evicted += rows
+            total -= freed
+
+        metrics.increment("result_cache.expired", expired)
+        metrics.increment("result_cache.evicted", evicted)
+        metrics.set_gauge("result_cache.bytes", total)
+
+
+RESULT_CACHE = open_optional("Result cache", RESULT_CACHE_PATH, ResultCache)
@@ -0,0 +1,53 @@
+import os
+import sqlite3
+import threading
+from typing import Callable, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+
+
+class WALDatabase:
+    """
+    One SQLite file in WAL mode, with a connection per thread.
+
+    WAL lets readers in other threads and processes proceed while one
+    writes. `schema` (CREATE ... IF NOT EXISTS statements) runs on every new
+    connection, so whichever thread or process opens the file first creates
+    the tables.
+    """
+
+    def __init__(self, path: str, schema: Sequence[str], timeout: float = 5.0):
+        self.path = path
+        self.schema = tuple(schema)
+        self.timeout = timeout
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connect()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.schema:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+
+def open_optional(name: str, path: str, factory: Callable[[str], T]) -> Optional[T]:
+    """
+    factory(path), or None when `path` is empty (the feature is turned off)
+    or the file can't be opened: a read-only filesystem disables the
+    feature, not the API.
+    """
+    if not path:
+        return None
+    try:
+        return factory(path)
+    except (OSError, sqlite3.Error) as e:
+        print(f"{name} disabled: {e}")
+        return None
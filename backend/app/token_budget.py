@@ -0,0 +1,204 @@
+import csv
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to a character-based estimate
+    tiktoken = None
+
+# Embedding input limit (text-embedding-3-small accepts 8191 tokens)
+EMBED_MAX_TOKENS = int(os.getenv("EMBED_MAX_TOKENS", "8000"))
+# Longer inputs are embedded as at most EMBED_MAX_CHUNKS evenly spaced chunks, mean-pooled
+EMBED_CHUNK_TOKENS = int(os.getenv("EMBED_CHUNK_TOKENS", "1000"))
+EMBED_MAX_CHUNKS = int(os.getenv("EMBED_MAX_CHUNKS", "8"))
+# Budget for the user text interpolated into the generation instruction
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "3000"))
+# Consecutive delimited lines needed before a run is treated as pasted data
+DATA_BLOCK_MIN_ROWS = int(os.getenv("DATA_BLOCK_MIN_ROWS", "5"))
+# Within budget, only blocks of at least this many tokens are summarized (an over-budget prompt has all summarized)
+DATA_BLOCK_MIN_TOKENS = int(os.getenv("DATA_BLOCK_MIN_TOKENS", "200"))
+DATA_SAMPLE_ROWS = 3
+
+DELIMITERS = [",", "\t", ";", "|"]
+DELIMITER_NAMES = {",": "comma", "\t": "tab", ";": "semicolon", "|": "pipe"}
+CHARS_PER_TOKEN = 4
+# Bullets and numbered items are prose, however many commas they contain
+LIST_MARKER_PATTERN = re.compile(r"\s*(?:[-*+\u2022]|\d+[.)])\s")
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and tiktoken is not None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # The BPE file is fetched on first use; offline hosts use the estimate instead
+            print(f"Token counting falls back to estimates: {e}")
+            _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Local token count (tiktoken when installed, otherwise ~4 characters per token)."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def split_tokens(text: str, size: int) -> List[str]:
+    """Splits text into consecutive pieces of at most `size` tokens."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        ids = encoding.encode(text, disallowed_special=())
+        return [encoding.decode(ids[i:i + size]) for i in range(0, len(ids), size)]
+    step = size * CHARS_PER_TOKEN
+    return [text[i:i + step] for i in range(0, len(text), step)]
+
+
+def truncate_middle(text: str, max_tokens: int) -> Tuple[str, bool]:
+    """Keeps the head and tail of an over-long text, where requests and questions usually sit."""
+    total = count_tokens(text)
+    if total <= max_tokens:
+        return text, False
+    half = max(max_tokens // 2, 1)
+    encoding = _get_encoding()
+    if encoding is not None:
+        ids = encoding.encode(text, disallowed_special=())
+        head, tail = encoding.decode(ids[:half]), encoding.decode(ids[-half:])
+    else:
+        head, tail = text[:half * CHARS_PER_TOKEN], text[-half * CHARS_PER_TOKEN:]
+    return f"{head}\n\n[... {total - 2 * half} tokens omitted ...]\n\n{tail}", True
+
+
+def embedding_chunks(text: str) -> List[str]:
+    """
+    The texts to embed for similarity: the text itself when it fits, otherwise
+    up to EMBED_MAX_CHUNKS chunks spread evenly across it (cost stays bounded).
+    """
+    if count_tokens(text) <= EMBED_MAX_TOKENS:
+        return [text]
+    chunks = split_tokens(text, EMBED_CHUNK_TOKENS)
+    if len(chunks) > EMBED_MAX_CHUNKS:
+        step = len(chunks) / float(EMBED_MAX_CHUNKS)
+        chunks = [chunks[int(i * step)] for i in range(EMBED_MAX_CHUNKS)]
+    return chunks
+
+
+def _line_signature(line: str) -> Optional[Tuple[str, int]]:
+    if LIST_MARKER_PATTERN.match(line):
+        return None
+    counts = [(line.count(d), d) for d in DELIMITERS]
+    count, delimiter = max(counts)
+    return (delimiter, count) if count else None
+
+
+def find_data_blocks(text: str) -> List[Tuple[int, int, str]]:
+    """
+    Finds runs of consecutive lines that split into the same number of fields
+    on the same delimiter and look tabular (see _looks_tabular).
+    Returns (start line, end line exclusive, delimiter).
+    """
+    lines = text.split("\n")
+    blocks = []
+    start, signature = 0, None
+    for i, line in enumerate(lines + [""]):
+        current = _line_signature(line) if line.strip() else None
+        if current != signature:
+            if (signature is not None and i - start >= DATA_BLOCK_MIN_ROWS and
+                    _looks_tabular(lines[start:i], *signature)):
+                blocks.append((start, i, signature[0]))
+            start, signature = i, current
+    return blocks
+
+
+def _to_number(value: str) -> Optional[float]:
+    try:
+        return float(value.replace("$", "").replace("%", "").replace(",", "").strip())
+    except ValueError:
+        return None
+
+
+def _looks_tabular(lines: List[str], delimiter: str, count: int) -> bool:
+    """
+    Same-shaped lines are only a table with more evidence than that: at least
+    three fields per row, or a column that is numeric in every row (the
+    first row may be a header). Prose with one comma per sentence is neither.
+    """
+    if count >= 2:
+        return True
+    rows = list(csv.reader(lines, delimiter=delimiter))[1:]
+    columns = min(len(row) for row in rows)
+    return any(all(_to_number(row[col]) is not None for row in rows) for col in range(columns))
+
+
+def summarize_data_block(lines: List[str], delimiter: str) -> str:
+    """Compact description of a pasted table: shape, columns, numeric ranges, a few sample rows."""
+    rows = list(csv.reader(lines, delimiter=delimiter))
+    header = None
+    if rows and all(_to_number(cell) is None for cell in rows[0]):
+        header, rows = [cell.strip() for cell in rows[0]], rows[1:]
+    n_columns = max(len(row) for row in rows) if rows else len(header or [])
+    names = header or [f"column {i + 1}" for i in range(n_columns)]
+
+    numeric = []
+    for col, name in enumerate(names):
+        values = [_to_number(row[col]) for row in rows if col < len(row)]
+        values = [v for v in values if v is not None]
+        if values and len(values) >= len(rows) // 2:
+            numeric.append(f"{name} (min {min(values):g}, mean {sum(values) / len(values):g}, max {max(values):g})")
+
+    summary = [f"[Data block summarized locally: {len(rows)} rows x {n_columns} columns, "
+               f"{DELIMITER_NAMES[delimiter]}-separated]"]
+    if header:
+        summary.append("Columns: " + ", ".join(header))
+    if numeric:
+        summary.append("Numeric columns: " + "; ".join(numeric))
+    summary.append("Sample rows:")
+    summary.extend(delimiter.join(row) for row in rows[:DATA_SAMPLE_ROWS])
+    return "\n".join(summary)
+
+
+def prepare_prompt(prompt: str) -> Dict:
+    """
+    Bounds the cost of a user prompt before it reaches the upstream.
+
+    Pasted tables are replaced by local summaries (all of them when the
+    prompt is over budget, otherwise only large ones), then the result is
+    truncated (head and tail kept) to PROMPT_MAX_TOKENS.
+    Returns: {
+        'text': str,            # what goes into the instruction and similarity
+        'original_tokens': int,
+        'tokens': int,
+        'data_blocks': int,     # tables summarized
+        'truncated': bool
+    }
+    """
+    original_tokens = count_tokens(prompt)
+    blocks = find_data_blocks(prompt) if "\n" in prompt else []
+    if blocks and original_tokens <= PROMPT_MAX_TOKENS:
+        # The prompt fits as it is: keep small tables verbatim, they are cheap and may be the point
+        lines = prompt.split("\n")
+        blocks = [block for block in blocks
+                  if count_tokens("\n".join(lines[block[0]:block[1]])) >= DATA_BLOCK_MIN_TOKENS]
+    text = prompt
+    if blocks:
+        lines = prompt.split("\n")
+        # Replace from the end so earlier line numbers stay valid
+        for start, end, delimiter in reversed(blocks):
+            lines[start:end] = [summarize_data_block(lines[start:end], delimiter)]
+        text = "\n".join(lines)
+
+    text, truncated = truncate_middle(text, PROMPT_MAX_TOKENS)
+    return {
+        'text': text,
+        'original_tokens': original_tokens,
+        'tokens': count_tokens(text) if (blocks or truncated) else original_tokens,
+        'data_blocks': len(blocks),
+        'truncated': truncated
+    }
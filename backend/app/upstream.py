@@ -0,0 +1,251 @@
+"""
+Every call to the upstream model API goes through this module.
+
+UPSTREAM_MODE selects what a call does:
+    live    - calls the API (default)
+    record  - calls the API and appends each request/response pair, with its
+              latency, to fixture files under UPSTREAM_FIXTURES_DIR
+    replay  - serves the recorded responses and never touches the network;
+              no API key is needed
+
+    cd backend
+    UPSTREAM_MODE=record python test_hybrid.py     # once, with a key
+    UPSTREAM_MODE=replay python test_hybrid.py     # anywhere, same answers
+
+With UPSTREAM_REPLAY_TIMING=true replay also waits the recorded latency of
+each call, so end-to-end benchmarks (e.g. app.bulk over a prompt file) show
+realistic timings on a machine without network access.
+"""
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+from openai import OpenAI
+
+from app.cancellation import RequestCancelled, current_cancel_token
+from app.hedging import COMPLETION_HEDGER
+from app.ledger import record_usage
+from app.metrics import metrics
+from app.token_budget import count_tokens
+
+UPSTREAM_MODE = os.getenv("UPSTREAM_MODE", "live")
+UPSTREAM_FIXTURES_DIR = os.getenv("UPSTREAM_FIXTURES_DIR", "fixtures/upstream")
+UPSTREAM_REPLAY_TIMING = os.getenv("UPSTREAM_REPLAY_TIMING", "false").lower() == "true"
+
+if UPSTREAM_MODE not in ("live", "record", "replay"):
+    raise ValueError(f"UPSTREAM_MODE must be live, record or replay, not {UPSTREAM_MODE!r}")
+
+
+class FixtureMissing(LookupError):
+    """Replay was asked for a request that was never recorded."""
+
+
+class FixtureStore:
+    """
+    Recorded exchanges, one JSONL file per kind (completions, embeddings).
+
+    Each line is {"key", "request", "response", "latency_ms"}, where key is a
+    hash of the canonical request. A request recorded several times (sampled
+    completions) is replayed in recording order, cycling, so a given sequence
+    of calls always gets the same answers.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._recordings: Dict[str, Dict[str, List[Dict]]] = {}
+        self._cursors: Dict[tuple, int] = {}
+
+    @staticmethod
+    def key(request: Dict) -> str:
+        return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def _path(self, kind: str) -> str:
+        return os.path.join(self.directory, f"{kind}.jsonl")
+
+    def record(self, kind: str, request: Dict, response: Dict, latency_ms: float):
+        line = orjson.dumps({"key": self.key(request), "request": request,
+                             "response": response, "latency_ms": round(latency_ms, 3)})
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(kind), "ab") as f:
+                f.write(line + b"\n")
+        metrics.increment(f"upstream.recorded.{kind}")
+
+    def _load(self, kind: str) -> Dict[str, List[Dict]]:
+        if kind not in self._recordings:
+            recordings: Dict[str, List[Dict]] = {}
+            if os.path.exists(self._path(kind)):
+                with open(self._path(kind), "rb") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = orjson.loads(line)
+                            recordings.setdefault(entry["key"], []).append(entry)
+            self._recordings[kind] = recordings
+        return self._recordings[kind]
+
+    def replay(self, kind: str, request: Dict) -> Dict:
+        """Returns the next recorded {"response", "latency_ms", ...} entry for this request."""
+        key = self.key(request)
+        with self._lock:
+            entries = self._load(kind).get(key)
+            if not entries:
+                preview = orjson.dumps(request)[:200].decode("utf-8", "replace")
+                raise FixtureMissing(f"No recorded {kind} response for {preview} in {self.directory}")
+            cursor = self._cursors.get((kind, key), 0)
+            self._cursors[(kind, key)] = cursor + 1
+        metrics.increment(f"upstream.replayed.{kind}")
+        return entries[cursor % len(entries)]
+
+
+FIXTURES = FixtureStore(UPSTREAM_FIXTURES_DIR)
+
+
+def create_client(api_key: Optional[str]) -> Optional[OpenAI]:
+    """The API client, or None without a key. Replay needs no key; its client is never called."""
+    if api_key:
+        return OpenAI(api_key=api_key)
+    if UPSTREAM_MODE == "replay":
+        return OpenAI(api_key="replay")
+    return None
+
+
+def _pause(seconds: float):
+    """Sleeps for a replayed latency, waking early if the current work is cancelled."""
+    token = current_cancel_token()
+    if token is None:
+        time.sleep(seconds)
+        return
+    wake = threading.Event()
+    unregister = token.on_cancel(wake.set)
+    try:
+        wake.wait(seconds)
+    finally:
+        unregister()
+    token.raise_if_cancelled()
+
+
+def _replay(kind: str, request: Dict) -> Dict:
+    token = current_cancel_token()
+    if token is not None:
+        token.raise_if_cancelled()
+    entry = FIXTURES.replay(kind, request)
+    if UPSTREAM_REPLAY_TIMING:
+        _pause(entry["latency_ms"] / 1000.0)
+    return entry["response"]
+
+
+def chat_completion(client, model: str, messages: List[Dict], temperature: float, max_tokens: int) -> str:
+    """One chat completion; returns the message text. Its token usage goes to the ledger row, if any."""
+    request = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+    if UPSTREAM_MODE == "replay":
+        response = _replay("completions", request)
+        # Fixtures recorded before usage was kept have none
+        record_usage(model, response.get("usage"))
+        return response["content"]
+
+    started = time.perf_counter()
+    # Each attempt records its own usage, so a hedge's losing attempt is counted too
+    content, usage = COMPLETION_HEDGER.complete(lambda: _live_chat_completion(client, request),
+                                                kind=(model, max_tokens))
+    if UPSTREAM_MODE == "record":
+        FIXTURES.record("completions", request, {"content": content, "usage": usage},
+                        (time.perf_counter() - started) * 1000)
+    return content
+
+
+def _usage(usage) -> Optional[Dict]:
+    """Token counts from the API's usage object (None when the response carried none)."""
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cached_tokens": (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+    }
+
+
+def _live_chat_completion(client, request: Dict) -> Tuple[str, Optional[Dict]]:
+    """
+    Inside a cancel scope the completion is streamed, and cancelling the
+    token closes the stream: the connection is released straight away and the
+    upstream stops generating tokens nobody will read.
+    """
+    token = current_cancel_token()
+    if token is None:
+        response = client.chat.completions.create(**request)
+        usage = _usage(getattr(response, "usage", None))
+        record_usage(request["model"], usage)
+        return response.choices[0].message.content or "", usage
+
+    token.raise_if_cancelled()
+    started = time.perf_counter()
+    # include_usage adds a final chunk (with no choices) carrying the token counts
+    stream = client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+    # Closing from the cancelling thread interrupts a read that is blocked waiting for the next chunk
+    unregister = token.on_cancel(stream.close)
+    parts = []
+    usage = None
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if token.cancelled:
+                break
+    except Exception:
+        if not token.cancelled:
+            raise
+    finally:
+        unregister()
+
+    if token.cancelled:
+        stream.close()
+        metrics.increment("upstream.completions_cancelled")
+        metrics.observe("upstream.cancelled_after_ms", (time.perf_counter() - started) * 1000)
+        # Roughly one token per chunk: how far the completion got before it was stopped
+        metrics.observe("upstream.cancelled_at_chunks", len(parts))
+        # A stopped stream never gets its usage chunk, but its prompt and the tokens
+        # generated so far are still billed; record an estimate
+        record_usage(request["model"], {
+            "prompt_tokens": sum(count_tokens(message["content"]) for message in request["messages"]),
+            "completion_tokens": len(parts),
+            "cached_tokens": 0
+        })
+        raise RequestCancelled()
+    usage = _usage(usage)
+    record_usage(request["model"], usage)
+    return "".join(parts), usage
+
+
+def create_embeddings(client, texts: List[str], model: str, dimensions: Optional[int] = None) -> List[List[float]]:
+    """
+    One embeddings call for several inputs; vectors come back in input order.
+    Fixtures are kept per input text, because how texts are grouped into
+    calls depends on the timing of concurrent requests.
+    """
+    requests = [{"model": model, "dimensions": dimensions, "input": text} for text in texts]
+    if UPSTREAM_MODE == "replay":
+        token = current_cancel_token()
+        if token is not None:
+            token.raise_if_cancelled()
+        entries = [FIXTURES.replay("embeddings", request) for request in requests]
+        if UPSTREAM_REPLAY_TIMING:
+            # The texts were embedded together, so the call took as long as its slowest recording
+            _pause(max(entry["latency_ms"] for entry in entries) / 1000.0)
+        return [entry["response"]["embedding"] for entry in entries]
+
+    started = time.perf_counter()
+    kwargs = {"dimensions": dimensions} if dimensions else {}
+    response = client.embeddings.create(input=texts, model=model, **kwargs)
+    vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    if UPSTREAM_MODE == "record":
+        latency_ms = (time.perf_counter() - started) * 1000
+        for request, vector in zip(requests, vectors):
+            FIXTURES.record("embeddings", request, {"embedding": vector}, latency_ms)
+    return vectors
@@ -0,0 +1,158 @@
+"""
+Local vagueness pre-filter, run before the embedding call.
+
+Obvious cases ("do it", "help", or a long prompt full of domain terms) are
+settled from cheap features in microseconds; only ambiguous prompts go on to
+the embedding comparison against the curated set.
+
+    python -m app.vagueness app/vagueness_labeled.jsonl
+
+reports, over a labeled set, how many prompts the pre-filter settles and how
+often it agrees with the embedding decision (and with the labels).
+"""
+import os
+import re
+import time
+from typing import Dict, Optional
+
+from app.intent_classifier import IntentClassifier
+from app.metrics import metrics
+
+VAGUENESS_PREFILTER = os.getenv("VAGUENESS_PREFILTER", "true").lower() == "true"
+# Clearly specific: at least this many words and pattern hits, with mostly content words
+PREFILTER_SPECIFIC_MIN_WORDS = int(os.getenv("PREFILTER_SPECIFIC_MIN_WORDS", "10"))
+PREFILTER_SPECIFIC_MIN_HITS = int(os.getenv("PREFILTER_SPECIFIC_MIN_HITS", "2"))
+PREFILTER_SPECIFIC_MIN_DENSITY = 0.5
+# Clearly vague: no intent pattern hits and no content words at all ("do it", "make it better"),
+# or a short prompt made almost entirely of function words ("can you do that thing for me").
+# Being short is not enough: "explain quantum computing" has no pattern hits but is specific.
+PREFILTER_VAGUE_MAX_DENSITY = 0.35
+PREFILTER_LOW_DENSITY_MAX_WORDS = 8
+
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "if", "then", "so", "of", "to", "in", "on", "at", "by",
+    "for", "with", "from", "about", "as", "into", "it", "its", "this", "that", "these", "those",
+    "i", "me", "my", "we", "us", "our", "you", "your", "he", "she", "they", "them", "is", "are",
+    "was", "were", "be", "been", "am", "do", "does", "did", "doing", "done", "can", "could",
+    "will", "would", "should", "may", "might", "must", "have", "has", "had", "get", "got",
+    "make", "made", "please", "just", "some", "something", "anything", "thing", "things",
+    "stuff", "help", "want", "need", "like", "what", "how", "why", "which", "who", "there",
+    "here", "all", "any", "more", "better", "good", "nice", "now", "again", "up", "out", "not"
+}
+
+WORD_PATTERN = re.compile(r"[a-z0-9][a-z0-9'+#.-]*")
+
+_classifier = None
+
+
+def prompt_features(text: str) -> Dict:
+    """Cheap features of a prompt: word counts, lexical density and intent pattern hits."""
+    global _classifier
+    if _classifier is None:
+        _classifier = IntentClassifier()
+    words = WORD_PATTERN.findall(text.lower())
+    content_words = [w for w in words if w not in STOPWORDS]
+    context = _classifier.classify_intent(text)['context']
+    return {
+        'words': len(words),
+        'content_words': len(content_words),
+        'lexical_density': len(content_words) / float(len(words)) if words else 0.0,
+        'pattern_hits': context['pattern_hits'],
+        'query_length': context['query_length']
+    }
+
+
+def prefilter_vagueness(text: str) -> Optional[bool]:
+    """True when clearly vague, False when clearly specific, None when the embedding should decide."""
+    features = prompt_features(text)
+    if features['pattern_hits'] == 0:
+        if features['words'] and features['content_words'] == 0:
+            return True
+        if (features['query_length'] <= PREFILTER_LOW_DENSITY_MAX_WORDS and
+                features['lexical_density'] <= PREFILTER_VAGUE_MAX_DENSITY):
+            return True
+    if (features['query_length'] >= PREFILTER_SPECIFIC_MIN_WORDS and
+            features['pattern_hits'] >= PREFILTER_SPECIFIC_MIN_HITS and
+            features['lexical_density'] >= PREFILTER_SPECIFIC_MIN_DENSITY):
+        return False
+    return None
+
+
+def prefiltered_similarity(text: str) -> Optional[Dict]:
+    """
+    The pre-filter's decision in analyze_prompt_similarity's result format, or
+    None for ambiguous prompts. No similarity was measured, so similarity_score
+    is None ('source' is 'prefilter').
+    """
+    start = time.perf_counter()
+    decision = prefilter_vagueness(text)
+    metrics.observe("vagueness.prefilter_us", (time.perf_counter() - start) * 1e6)
+    if decision is None:
+        metrics.increment("vagueness.prefilter_ambiguous")
+        return None
+    metrics.increment("vagueness.prefilter_vague" if decision else "vagueness.prefilter_specific")
+    return {
+        'similarity_score': None,
+        'is_vague': decision,
+        'neighbours': [],
+        'intent': None,
+        'source': 'prefilter'
+    }
+
+
+def agreement_report(path: str) -> Dict:
+    """
+    Runs the pre-filter and the embedding decision over a labeled JSONL set
+    ({"prompt": ..., "vague": true/false} per line).
+    """
+    import orjson
+    from app.embeddings import analyze_prompt_similarity
+
+    rows = []
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                rows.append(orjson.loads(line))
+
+    settled = agree = prefilter_correct = embedding_correct = 0
+    disagreements = []
+    for row in rows:
+        local = prefilter_vagueness(row['prompt'])
+        embedded = analyze_prompt_similarity(row['prompt'], top_k=1)['is_vague']
+        embedding_correct += embedded == row['vague']
+        if local is None:
+            continue
+        settled += 1
+        agree += local == embedded
+        prefilter_correct += local == row['vague']
+        if local != embedded:
+            disagreements.append({'prompt': row['prompt'], 'label': row['vague'],
+                                  'prefilter': local, 'embedding': embedded})
+
+    return {
+        'prompts': len(rows),
+        'settled_locally': settled,
+        'coverage': settled / float(len(rows)) if rows else 0.0,
+        'agreement_with_embedding': agree / float(settled) if settled else 0.0,
+        'prefilter_accuracy': prefilter_correct / float(settled) if settled else 0.0,
+        'embedding_accuracy': embedding_correct / float(len(rows)) if rows else 0.0,
+        'disagreements': disagreements
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Agreement of the vagueness pre-filter with the embedding decision")
+    parser.add_argument("labeled", help="JSONL with {\"prompt\": ..., \"vague\": true/false} per line")
+    args = parser.parse_args()
+
+    report = agreement_report(args.labeled)
+    print(f"Prompts:                    {report['prompts']}")
+    print(f"Settled locally:            {report['settled_locally']} ({report['coverage']:.0%})")
+    print(f"Agreement with embedding:   {report['agreement_with_embedding']:.1%} (of settled)")
+    print(f"Pre-filter vs labels:       {report['prefilter_accuracy']:.1%} (of settled)")
+    print(f"Embedding vs labels:        {report['embedding_accuracy']:.1%} (all prompts)")
+    for row in report['disagreements']:
+        print(f"  disagree: {row['prompt'][:70]!r} label={row['label']} "
+              f"prefilter={row['prefilter']} embedding={row['embedding']}")
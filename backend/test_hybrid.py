@@ -7,6 +7,10 @@ sys.path.append(os.path.join(os.getcwd(), 'app'))
 from app.prompt_engine import generate_systematic_prompt
 from app.embeddings import analyze_similarity
 
+def format_score(score):
+    # The local pre-filter settles obvious prompts without measuring a similarity
+    return "settled by prefilter" if score is None else f"{score:.4f}"
+
 def test_hybrid_system():
     print("=== Testing Hybrid AI System ===")
     
@@ -14,7 +18,7 @@ def test_hybrid_system():
     print("\n[Test 1] Vague Prompt: 'do it'")
     vague_prompt = "do it"
     sim_score, is_vague = analyze_similarity(vague_prompt)
-    print(f"Similarity Score: {sim_score:.4f}")
+    print(f"Similarity Score: {format_score(sim_score)}")
     print(f"Is Vague? {is_vague}")
     
     if is_vague:
@@ -26,10 +30,10 @@ def test_hybrid_system():
     print("\n[Test 2] Good Prompt: 'Write a Python script to scrape data'")
     good_prompt = "Write a Python script to scrape product data from Amazon using BeautifulSoup"
     sim_score_good, is_vague_good = analyze_similarity(good_prompt)
-    print(f"Similarity Score: {sim_score_good:.4f}")
+    print(f"Similarity Score: {format_score(sim_score_good)}")
     print(f"Is Vague? {is_vague_good}")
     
-    if not is_vague_good and sim_score_good > 0.8:
+    if not is_vague_good and (sim_score_good is None or sim_score_good > 0.8):
         print("✅ PASS: Correctly identified as high quality.")
     else:
         print(f"❌ FAIL: Should be high quality. Score: {sim_score_good}")
@@ -39,7 +43,7 @@ def test_hybrid_system():
     try:
         result = generate_systematic_prompt("Create a snake game in python")
         print("Generated Structured Prompt successfully.")
-        print(f"Similarity Score in Result: {result.similarity_score}")
+        print(f"Similarity Score in Result: {format_score(result.similarity_score)}")
         print(f"Is Vague in Result: {result.is_vague}")
         print("Enhancement Preview:\n" + result.original_prompt)
     except Exception as e:
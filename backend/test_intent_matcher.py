@@ -0,0 +1,92 @@
+"""
+Equivalence check for the intent matcher: the Aho-Corasick path
+(KeywordAutomaton + CompiledPatterns.score) against plain substring
+scoring, on fuzzed queries built from the pattern vocabulary.
+
+    cd backend
+    python test_intent_matcher.py --queries 20000
+
+Run it after editing intent_patterns.json, pattern_matcher.py or the
+scoring in intent_registry.py. Exits non-zero on the first mismatches.
+"""
+import argparse
+import random
+import sys
+
+from app.intent_classifier import IntentClassifier
+from app.intent_registry import PATTERN_WEIGHTS, get_registry
+
+FILLER = ["the", "a", "for", "my", "please", "quick", "new", "from", "with", "and",
+          "ad", "app", "4k", "blog", "data", "plan", "x", "", " ", "!", "?", "é", "数据"]
+
+
+def reference_scores(query: str, intent_patterns: dict) -> dict:
+    """Scoring as the classifier did it before the automaton: one `in` test per pattern term."""
+    scores = {}
+    for primary, sub_intents in intent_patterns.items():
+        for sub_intent, patterns in sub_intents.items():
+            scores[f"{primary}.{sub_intent}"] = sum(
+                weight for kind, weight in PATTERN_WEIGHTS.items()
+                for term in patterns.get(kind, []) if term in query
+            )
+    return scores
+
+
+def reference_intent(query: str, classifier: IntentClassifier, intent_patterns: dict) -> tuple:
+    scores = reference_scores(query, intent_patterns)
+    top = max(scores.items(), key=lambda x: x[1])
+    if top[1] > 0:
+        primary, sub = top[0].split('.')
+        return primary, sub, min(top[1] / 10.0, 1.0)
+    primary, sub = classifier._fallback_intent(query)
+    return primary, sub, 0.5
+
+
+def fuzz_queries(terms: list, n: int, seed: int):
+    rng = random.Random(seed)
+    for _ in range(n):
+        words = []
+        for _ in range(rng.randint(1, 12)):
+            pick = rng.random()
+            if pick < 0.45:
+                word = rng.choice(terms)
+            elif pick < 0.6:
+                # Fragments and run-together terms exercise overlapping matches
+                word = rng.choice(terms)
+                cut = rng.randint(0, len(word))
+                word = word[:cut] if rng.random() < 0.5 else word[cut:] + rng.choice(terms)
+            else:
+                word = rng.choice(FILLER)
+            words.append(word)
+        query = rng.choice([" ", "", "-"]).join(words)
+        yield query.upper() if rng.random() < 0.1 else query
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the intent matcher against substring scoring")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    patterns = get_registry().current
+    classifier = IntentClassifier()
+    terms = patterns.automaton.terms
+
+    mismatches = 0
+    for query in fuzz_queries(terms, args.queries, args.seed):
+        lowered = query.lower()
+        found = patterns.automaton.find(lowered)
+        expected_terms = {i for i, term in enumerate(terms) if term in lowered}
+        result = classifier.classify_intent(query)
+        actual = (result['primary_intent'], result['sub_intent'], result['confidence'])
+        expected = reference_intent(lowered, classifier, patterns.intent_patterns)
+        if (found != expected_terms or patterns.score(lowered) != reference_scores(lowered, patterns.intent_patterns)
+                or actual != expected):
+            mismatches += 1
+            print(f"MISMATCH {query!r}: got {actual}, expected {expected}")
+            if mismatches >= 20:
+                break
+
+    print(f"Checked {args.queries} queries against patterns version {patterns.version}: "
+          f"{'OK' if not mismatches else f'{mismatches} mismatches'}")
+    sys.exit(1 if mismatches else 0)